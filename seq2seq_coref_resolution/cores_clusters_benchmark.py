@@ -0,0 +1,69 @@
+import sys
+import time
+import random
+import argparse
+
+from utils import merge_clusters
+
+# The merge create_seperate_clusters did before merge_clusters: every pair of sets is intersected and the inner loop
+# starts over after every merge
+def pairwise_merge(clusters):
+    clusters = [set(cluster) for cluster in clusters]
+    i = 0
+    while i < len(clusters):
+        j = i + 1
+        while j < len(clusters):
+            if clusters[i] & clusters[j]:
+                clusters[i] = clusters[i].union(clusters[j])
+                del clusters[j]
+                j = i + 1
+                continue
+            j += 1
+        i += 1
+    return [list(c) for c in clusters]
+
+# pred_obj_clusters_golden_idxs of a document: every mention with the mentions the model put in its cluster, which
+# are mostly right (its true cluster) and sometimes miss or add a mention
+def random_document(mentions_count, clusters_count, noise=0.05):
+    mentions = [(i * 3, i * 3 + random.randint(0, 2)) for i in range(mentions_count)]
+    true_clusters = [random.randrange(clusters_count) for _ in mentions]
+    members = {}
+    for mention, cluster in zip(mentions, true_clusters):
+        members.setdefault(cluster, []).append(mention)
+    document = {}
+    for mention, cluster in zip(mentions, true_clusters):
+        predicted = [m for m in members[cluster] if m != mention and random.random() > noise]
+        if random.random() < noise:
+            predicted.append(random.choice(mentions))
+        document[mention] = predicted
+    return document
+
+def partition(clusters):
+    return sorted(sorted(cluster) for cluster in clusters)
+
+def time_merge(merge, documents, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        results = [merge([key] + list(items) for key, items in document.items()) for document in documents]
+    return (time.time() - start) / (repeat * len(documents)), results
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('--mentions', type=int, nargs='+', default=[100, 200, 400, 800])
+    parser.add_argument('--clusters', type=float, default=0.2)
+    parser.add_argument('--documents', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(sys.argv[1:])
+
+    random.seed(0)
+    for mentions_count in args.mentions:
+        clusters_count = max(1, int(mentions_count * args.clusters))
+        documents = [random_document(mentions_count, clusters_count) for _ in range(args.documents)]
+        pairwise_time, pairwise_results = time_merge(pairwise_merge, documents, args.repeat)
+        union_find_time, union_find_results = time_merge(merge_clusters, documents, args.repeat)
+        same = all(partition(a) == partition(b) for a, b in zip(pairwise_results, union_find_results))
+        print(f'{mentions_count} mentions, {clusters_count} clusters: pairwise {pairwise_time * 1000:.2f}ms, ' \
+              f'union-find {union_find_time * 1000:.2f}ms (x{pairwise_time / union_find_time:.1f}), same clusters {same}')
+
+if __name__ == '__main__':
+    main()
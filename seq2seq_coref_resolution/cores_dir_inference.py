@@ -10,16 +10,19 @@ import pickle
 import time, threading, sys
 import re
 import difflib
+import itertools
+import unicodedata
 
 import datasets
 from datasets import Dataset, concatenate_datasets
 from datasets import Dataset, load_metric
 
-from utils import flatten_list_of_lists
+from utils import flatten_list_of_lists, merge_clusters
 import torch
+import numpy as np
 import pandas as pd
-from cores_tokens import UNK_CLUSTER_TOKEN, IN_CLUSTER_TOKEN, NOT_IN_CLUSTER_TOKEN
-from cores_tokens_test import CoresDatasetPreProcessorTest, monitor_inference
+from cores_tokens import UNK_CLUSTER_TOKEN, IN_CLUSTER_TOKEN, NOT_IN_CLUSTER_TOKEN, WordPieces
+from cores_tokens_test import CoresDatasetPreProcessorTest, monitor_inference, load_test_builder, same_paragraph
 
 # Training imports
 from transformers import T5ForConditionalGeneration, T5Tokenizer 
@@ -29,6 +32,7 @@ from transformers import BertTokenizerFast
 from transformers import T5Tokenizer
 from transformers import BertGenerationConfig, BertGenerationEncoder, BertGenerationDecoder, EncoderDecoderModel, EncoderDecoderConfig
 from transformers import Seq2SeqTrainingArguments, Seq2SeqTrainer
+from transformers import LogitsProcessor, LogitsProcessorList
 from utils import flatten_list_of_lists
 
 STARTING_TOKEN = '<<'
@@ -101,6 +105,24 @@ def inference(sentence):
     mentions_only = extract_mentions(sentence)
     return (mentions_envs, mentions_only)
 
+# the pretrained tokenizer of model_type with the cores tokens
+def load_tokenizer(model_type):
+    print("Loading tokenizer")
+    if 'bert' in model_type:
+        tokenizer = BertTokenizerFast.from_pretrained("bert-base-uncased")
+    if 't5' in model_type:
+        tokenizer = T5Tokenizer.from_pretrained("t5-small")
+    if 'bart' in model_type:
+        tokenizer = BartTokenizer.from_pretrained("facebook/bart-large")
+
+    if 't5' not in model_type:
+        tokenizer.bos_token = tokenizer.cls_token
+        tokenizer.eos_token = tokenizer.sep_token
+    cores_tokens = ['<<', '>>', '[[u]]', '[[t]]', '[[f]]']
+    tokenizer.add_tokens(cores_tokens)
+    tokenizer.model_max_length = 128
+    return tokenizer
+
 def load_pickles(model_type, dataset_builder_path, beam_size, config):
     os.environ["PYTHONUNBUFFERED"] = '1'
     if not ((beam_size > 0) and (beam_size < 10)):
@@ -130,24 +152,10 @@ def load_pickles(model_type, dataset_builder_path, beam_size, config):
         print('Please train {model_type} with {config}')
         sys.exit(0)
 
-    print("Loading tokenizer")
-    if 'bert' in model_type:
-        tokenizer = BertTokenizerFast.from_pretrained("bert-base-uncased")
-    if 't5' in model_type:
-        tokenizer = T5Tokenizer.from_pretrained("t5-small")
-    if 'bart' in model_type:
-        tokenizer = BartTokenizer.from_pretrained("facebook/bart-large")
-
-    if 't5' not in model_type:
-        tokenizer.bos_token = tokenizer.cls_token
-        tokenizer.eos_token = tokenizer.sep_token
-    cores_tokens = ['<<', '>>', '[[u]]', '[[t]]', '[[f]]']
-    tokenizer.add_tokens(cores_tokens)
-    tokenizer.model_max_length = 128
+    tokenizer = load_tokenizer(model_type)
 
     print("Loading Builder")
-    with open(dataset_builder_path, 'rb') as f:
-        builder = pickle.load(f)
+    builder = load_test_builder(dataset_builder_path)
 
     print(f'Latest checkpoint: {latest_checkpoint}')
     if 'bert' in model_type:
@@ -176,116 +184,265 @@ def generate_true_cluster_example(true_mention, sentence, model_output_mentions)
             sentence = sentence.replace(full_mention, replaced_full_mention)
         return sentence
 
-def create_suffix_map(words, words_str):
-    words = [(idx, word) for idx, word in enumerate(words)]
-    suffix_map = {}
-    substrings = []
-    for idx, word in words[::-1]:
-        if word: # for empty words
-            suffix = [word for _, word in words[idx:] if word]
-            suffix = ' '.join(suffix).replace('  ', ' ')
-            suffix_idx = words_str.find(suffix, len(words_str) - len(suffix), len(words_str))
-            suffix_map[suffix_idx] = idx
-    return suffix_map
-
-def execute_model(input_str, model, tokenizer, beam_size):
-    model.config.min_length = len(tokenizer.encode(input_str))
-    model.config.max_length = 128
-    input_str = [input_str,]
-    inputs  = tokenizer(input_str,  padding="max_length", truncation=True, max_length=128)
-    model_outputs = model.generate(torch.tensor(inputs.input_ids).to(CUDA_DEVICE), attention_mask=torch.tensor(inputs.attention_mask).to(CUDA_DEVICE), num_beams=beam_size ,num_return_sequences=1) #return_dict_in_generate=True, output_scores=True)
-    model_output_str = tokenizer.batch_decode(model_outputs, skip_special_tokens=True)
-    model_output_str = model_output_str[0]
-    return model_output_str
-
-def inference_example(model, tokenizer, words, beam_size, model_output_str=None):
-    model.config.no_repeat_ngram_size = None
-    # Suprise ! put the output mentions and check of good it good clustering only
-    if model_output_str is None:
-        # execute the model
-        input_str = ' '.join(words)
-        input_str = input_str.lower()
-        print('Input String')
-        print(input_str)
-        model_output_str = execute_model(input_str, model, tokenizer, beam_size)
-        print()
-        print('Model Output')
-        print(model_output_str)
-
-    # extract mentions from model output
-    model_mentions_string = model_output_str
-    model_output_mentions = extract_mentions_with_env(model_mentions_string)
-    #print(model_output_mentions)
-
-    # update mentions 
-    pred_obj_clusters = {}
-
-    cluster_pred_outputs = {}
-    # for each mention
+# min_length of every input of a batch: generate() takes a single min_length, so the eos of an input (all its beams)
+# is banned until the input has its own min_length tokens
+class BatchMinLengthLogitsProcessor(LogitsProcessor):
+    def __init__(self, min_lengths, eos_token_id, num_beams):
+        self.min_lengths = torch.tensor(min_lengths).repeat_interleave(num_beams)
+        self.eos_token_ids = eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+
+    def __call__(self, input_ids, scores):
+        too_short = (input_ids.shape[-1] < self.min_lengths).to(scores.device)
+        for eos_token_id in self.eos_token_ids:
+            scores[too_short, eos_token_id] = -float('inf')
+        return scores
+
+# Mentions stage decoding that can only copy its input: a beam takes the next sub-token of the input words or a
+# marker where the markup has one (a << before a word, a >> after a word once a mention was opened, the [[u]] right
+# after every >>) and the eos once all the words are copied. The words are tokenized as MarkupEncoder does for the
+# targets, without the leading space at the beginning and right after a marker.
+# generate() reorders the beams between steps without telling the processor, so a beam state is found by the
+# fingerprint of its sequence: every step fingerprints the sequences in one tensor operation, looks the state of
+# every beam up by the fingerprint of its sequence without the last token (the previous step saved it under that
+# fingerprint) and advances it by the last token. Only the states of the previous step are kept.
+class CopyMarkersLogitsProcessor(LogitsProcessor):
+    START, OPEN, WORD, CLOSE, TAG = range(5)
+    # two fingerprints modulo primes below 2**31, the products and sums stay far below 2**63
+    FINGERPRINT_PRIMES = (2147483647, 2147483629)
+    FINGERPRINT_BASES = (1000003, 999983)
+
+    def __init__(self, words_batch, word_pieces, eos_token_id, num_beams, prefix_ids=()):
+        # A word without sub-tokens (the tokenizer drops it, like a zero-width character for BERT, or an empty
+        # string between two spaces once it follows a marker) is not in the model input and has no pieces to
+        # copy, so the constraint skips it
+        self.words_batch = [[word for word in words if word_pieces(word) and word_pieces(word, leading_space=False)]
+                            for words in words_batch]
+        skipped = sum(len(words) for words in words_batch) - sum(len(words) for words in self.words_batch)
+        if skipped:
+            print(f'Copy constraint skips {skipped} words without sub-tokens')
+        self.word_pieces = word_pieces
+        self.eos_token_ids = eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+        self.num_beams = num_beams
+        self.prefix_ids = list(prefix_ids)
+        marker_ids = word_pieces.tokenizer.convert_tokens_to_ids([STARTING_TOKEN, ENDING_TOKEN, UNK_CLUSTER_TOKEN])
+        self.open_id, self.close_id, self.tag_id = marker_ids
+        self.powers = None
+        self.states = {}
+
+    # sub-tokens the output of words has at most: every word copied with a << before it and a >> [[u]] after it
+    @staticmethod
+    def max_length(words, word_pieces):
+        return sum(max(len(word_pieces(word)), len(word_pieces(word, leading_space=False))) + 3 for word in words)
+
+    # (kind of the last token, words copied, sub-tokens of the current word left, whether a mention was opened).
+    # Mentions starting at a word share its <<, and mentions ending at a word share its >>, so the << and >> of an
+    # output do not pair up. Any >> after some << is the end of a mention from that <<, which is why opened is
+    # only ever set and never counted down.
+    def _advance(self, state, words, token):
+        kind, word_index, pieces, opened = state
+        if pieces:
+            return (self.WORD, word_index, pieces[1:], opened)
+        if token == self.open_id:
+            return (self.OPEN, word_index, (), True)
+        if token == self.close_id:
+            return (self.CLOSE, word_index, (), opened)
+        if token == self.tag_id:
+            return (self.TAG, word_index, (), opened)
+        if word_index < len(words) and token not in self.eos_token_ids:
+            pieces = self.word_pieces(words[word_index], leading_space=(kind == self.WORD))
+            return (self.WORD, word_index + 1, tuple(pieces[1:]), opened)
+        return state
+
+    def _allowed(self, state, words, length):
+        kind, word_index, pieces, opened = state
+        if pieces:
+            return [pieces[0]]
+        if kind == self.CLOSE:
+            return [self.tag_id]
+        allowed = []
+        if word_index < len(words):
+            allowed.append(self.word_pieces(words[word_index], leading_space=(kind == self.WORD))[0])
+            if kind != self.OPEN:
+                allowed.append(self.open_id)
+        elif kind != self.OPEN:
+            allowed.extend(self.eos_token_ids)
+        if kind == self.WORD and opened:
+            allowed.append(self.close_id)
+        if kind == self.START and length == 1:
+            allowed.extend(self.prefix_ids)
+        return allowed
+
+    # the state of a sequence from the start, for a beam whose previous state is not known
+    def _replay(self, words, sequence):
+        state = (self.START, 0, (), False)
+        for token in sequence[1:]:
+            if token not in self.prefix_ids:
+                state = self._advance(state, words, token)
+        return state
+
+    # (fingerprints of the sequences, fingerprints of the sequences without their last token), one row per beam
+    def _fingerprints(self, input_ids):
+        length = input_ids.shape[-1]
+        if self.powers is None or self.powers.shape[0] < length or self.powers.device != input_ids.device:
+            powers = [[pow(base, i, prime) for base, prime in zip(self.FINGERPRINT_BASES, self.FINGERPRINT_PRIMES)]
+                      for i in range(max(2 * length, 64))]
+            self.powers = torch.tensor(powers, dtype=torch.long, device=input_ids.device)
+            self.primes = torch.tensor(self.FINGERPRINT_PRIMES, dtype=torch.long, device=input_ids.device)
+        primes = self.primes
+        terms = input_ids.long().unsqueeze(-1) * self.powers[:length] % primes
+        prefix = terms[:, :-1].sum(1) % primes
+        return ((prefix + terms[:, -1]) % primes).tolist(), prefix.tolist()
+
+    def __call__(self, input_ids, scores):
+        length = input_ids.shape[-1]
+        fingerprints, prefix_fingerprints = self._fingerprints(input_ids)
+        last_tokens = input_ids[:, -1].tolist()
+        states = {}
+        allowed_rows, allowed_ids = [], []
+        for row in range(input_ids.shape[0]):
+            batch = row // self.num_beams
+            words = self.words_batch[batch]
+            if length == 1:
+                state = (self.START, 0, (), False)
+            else:
+                previous = self.states.get((batch, length - 1) + tuple(prefix_fingerprints[row]))
+                if previous is None:
+                    previous = self._replay(words, input_ids[row, :-1].tolist())
+                token = last_tokens[row]
+                state = previous if token in self.prefix_ids else self._advance(previous, words, token)
+            states[(batch, length) + tuple(fingerprints[row])] = state
+            allowed = self._allowed(state, words, length)
+            allowed_rows.extend([row] * len(allowed))
+            allowed_ids.extend(allowed)
+        self.states = states
+        mask = torch.full_like(scores, -float('inf'))
+        mask[allowed_rows, allowed_ids] = 0
+        return scores + mask
+
+# Generates the outputs of input_strs, batch_size inputs per generate() call. Every output is the one execute_model
+# gives for its input alone: the padding is masked out and the output is at least as long as its input. The inputs
+# are padded to the longest input of their batch (padding="max_length" pads to 128 as before), so batches of
+# inputs of similar length (InferenceScheduler) do not pay for 128 encoder positions and their cross-attention.
+# With copy_input (mentions prompts) the outputs are decoded by CopyMarkersLogitsProcessor and no longer than the
+# markup of the input words allows.
+def execute_model_batch(input_strs, model, tokenizer, beam_size, batch_size=16, padding='longest', copy_input=False, word_pieces=None):
+    model_output_strs = []
+    if copy_input and word_pieces is None:
+        word_pieces = WordPieces(tokenizer)
+    eos_token_id = model.config.eos_token_id
+    if copy_input and eos_token_id is None:
+        eos_token_id = tokenizer.eos_token_id
+    prefix_ids = [token_id for token_id in (tokenizer.bos_token_id, tokenizer.cls_token_id) if token_id is not None]
+    for i in range(0, len(input_strs), batch_size):
+        batch = input_strs[i : i + batch_size]
+        inputs  = tokenizer(batch,  padding=padding, truncation=True, max_length=128)
+        logits_processor = LogitsProcessorList()
+        if copy_input:
+            words_batch = [input_str.split(' ') for input_str in batch]
+            word_pieces.update([word for words in words_batch for word in words], leading_space=True)
+            word_pieces.update([word for words in words_batch for word in words], leading_space=False)
+            max_length = max(CopyMarkersLogitsProcessor.max_length(words, word_pieces) for words in words_batch)
+            model.config.max_length = min(max_length + tokenizer.num_special_tokens_to_add() + 2, 128)
+            model.config.min_length = 0
+            logits_processor.append(CopyMarkersLogitsProcessor(words_batch, word_pieces, eos_token_id, beam_size, prefix_ids))
+        else:
+            min_lengths = [len(tokenizer.encode(input_str)) for input_str in batch]
+            model.config.max_length = 128
+            model.config.min_length = min(min_lengths)
+            if eos_token_id is not None:
+                logits_processor.append(BatchMinLengthLogitsProcessor(min_lengths, eos_token_id, beam_size))
+        model_outputs = model.generate(torch.tensor(inputs.input_ids).to(CUDA_DEVICE), attention_mask=torch.tensor(inputs.attention_mask).to(CUDA_DEVICE),
+                                       num_beams=beam_size, num_return_sequences=1, logits_processor=logits_processor)
+        model_output_strs.extend(tokenizer.batch_decode(model_outputs, skip_special_tokens=True))
+    return model_output_strs
+
+def execute_model(input_str, model, tokenizer, beam_size, copy_input=False):
+    return execute_model_batch([input_str], model, tokenizer, beam_size, copy_input=copy_input)[0]
+
+# Cluster stage outputs without generate(): the output of a cluster example is its input copied with every tag
+# ([[u]], and the [[t]] of the mention) decided to [[t]] or [[f]]. So the input itself, with [[f]] for the undecided
+# tags, is the decoder input of one teacher-forced forward pass, and every tag position gets the tag of the higher
+# probability among [[t]] and [[f]]. Returns the outputs (decoded as execute_model_batch does) and the P([[t]]) of
+# the tags of every output, in their order.
+def score_cluster_tags(input_strs, model, tokenizer, batch_size=16):
+    unk_id, in_id, not_in_id = tokenizer.convert_tokens_to_ids([UNK_CLUSTER_TOKEN, IN_CLUSTER_TOKEN, NOT_IN_CLUSTER_TOKEN])
+    tag_ids = torch.tensor([unk_id, in_id, not_in_id]).to(CUDA_DEVICE)
+    model_output_strs = []
+    tag_scores = []
+    for i in range(0, len(input_strs), batch_size):
+        batch = input_strs[i : i + batch_size]
+        inputs  = tokenizer(batch,  padding='longest', truncation=True, max_length=128)
+        input_ids = torch.tensor(inputs.input_ids).to(CUDA_DEVICE)
+        attention_mask = torch.tensor(inputs.attention_mask).to(CUDA_DEVICE)
+        labels = input_ids.masked_fill(input_ids == unk_id, not_in_id).masked_fill(attention_mask == 0, -100)
+        with torch.no_grad():
+            logits = model(input_ids=input_ids, attention_mask=attention_mask, labels=labels).logits
+        scores = logits[:, :, [in_id, not_in_id]].softmax(-1)[:, :, 0]
+        tags = torch.isin(input_ids, tag_ids) & (attention_mask == 1)
+        output_ids = torch.where(tags, torch.where(scores > 0.5, in_id, not_in_id), input_ids)
+        for j in range(len(batch)):
+            model_output_strs.append(tokenizer.decode(output_ids[j][attention_mask[j] == 1], skip_special_tokens=True))
+            tag_scores.append(scores[j][tags[j]].tolist())
+    return model_output_strs, tag_scores
+
+# The mentions of the model output and the cluster example of every mention, the inputs of the cluster stage
+def cluster_examples(model_output_str):
+    model_output_mentions = extract_mentions_with_env(model_output_str)
+    true_cluster_sentences = []
     for j, mention in enumerate(model_output_mentions):
         print(f'Mention ({j}): {mention}')
 
         # replace it to a cluster example
-        true_cluster_sentence = generate_true_cluster_example(mention, model_mentions_string, model_output_mentions)
+        true_cluster_sentence = generate_true_cluster_example(mention, model_output_str, model_output_mentions)
         print(f'Generate Cluster Sentence')
         print(true_cluster_sentence)
+        true_cluster_sentences.append(true_cluster_sentence)
+    return model_output_mentions, true_cluster_sentences
 
-        # execute the model and get the cluster tagging
-        model_output_str = execute_model(true_cluster_sentence, model, tokenizer, beam_size)
+# The cluster of every mention from the model outputs of its cluster example
+def tag_clusters(model_output_mentions, model_output_strs):
+    pred_obj_clusters = {}
+    cluster_pred_outputs = {}
+    for j, (mention, model_output_str) in enumerate(zip(model_output_mentions, model_output_strs)):
+        print(f'Mention ({j}): {mention}')
+        if model_output_str is None:
+            # skipped, an other mention put it in its cluster
+            pred_obj_clusters[mention] = []
+            cluster_pred_outputs[mention] = None
+            continue
         print('Cluster Tagging from Model:')
         print(model_output_str)
-        print()
         cluster_pred_outputs[mention] = model_output_str
 
-    # for each mention
-    for j, mention in enumerate(model_output_mentions):
-        print(f'Mention ({j}): {mention}')
-
-        model_output_str = cluster_pred_outputs[mention]
-
         # extract mentions and taggings from output
-        model_output_mentions = extract_mentions_with_env(model_output_str)
+        tagged_mentions = extract_mentions_with_env(model_output_str)
 
         # update_clusters
-        pred_obj_clusters[mention] = [ m for m in model_output_mentions if m[MEN_CLUSTER_TAG_IDX] == 't' ]
+        pred_obj_clusters[mention] = [ m for m in tagged_mentions if m[MEN_CLUSTER_TAG_IDX] == 't' ]
         print(pred_obj_clusters[mention])
     return pred_obj_clusters, cluster_pred_outputs
 
-def choose_by_env(mention, span_idxs, suffix_map, words, env_size=3):
-    words_starts = {}
-    chosen = None
-    max_score = -1
-    print(f'Candidate: {mention}')
-    for idx in span_idxs:
-        if idx in suffix_map:
-            start = suffix_map[idx]
-            words_count = len(mention[MEN_SPAN_STR_IDX].split(' '))
-            end = start + (words_count - 1)
-            span = ' '.join(words[start : end + 1])
-            renv = ' '.join(words[end + 1 : end + 1 + env_size])
-            lenv = ' '.join(words[max(0, start - env_size) : start])
-            renv = clean_text(renv)
-            lenv = clean_text(lenv)
-            span = clean_text(span)
-            print()
-            print((start, end))
-            print(span)
-            print(renv)
-            print(lenv)
-            renv_score = difflib.SequenceMatcher(None, renv, mention[MEN_RENV_IDX]).ratio()
-            lenv_score = difflib.SequenceMatcher(None, lenv, mention[MEN_LENV_IDX]).ratio()
-            score = renv_score + lenv_score
-            print(score)
-            if score > max_score:
-                chosen = (start, end)
-                max_score   = score
-    print('====')
-    print(mention[MEN_LENV_IDX])
-    print(mention[MEN_RENV_IDX])
-    print(mention[MEN_SPAN_STR_IDX])
-    print(chosen)
-    print('====')
-    return chosen
+def inference_example(model, tokenizer, words, beam_size, model_output_str=None, batch_size=16, score_tags=False, copy_mentions=False):
+    model.config.no_repeat_ngram_size = None
+    # Suprise ! put the output mentions and check of good it good clustering only
+    if model_output_str is None:
+        # execute the model
+        input_str = ' '.join(words)
+        input_str = input_str.lower()
+        print('Input String')
+        print(input_str)
+        model_output_str = execute_model(input_str, model, tokenizer, beam_size, copy_input=copy_mentions)
+        print()
+        print('Model Output')
+        print(model_output_str)
+
+    # execute the model on the cluster examples of all the mentions and get the cluster taggings
+    model_output_mentions, true_cluster_sentences = cluster_examples(model_output_str)
+    if score_tags:
+        model_output_strs, _ = score_cluster_tags(true_cluster_sentences, model, tokenizer, batch_size)
+    else:
+        model_output_strs = execute_model_batch(true_cluster_sentences, model, tokenizer, beam_size, batch_size)
+    return tag_clusters(model_output_mentions, model_output_strs)
 
 CORES_SPECIAL_TOKENS = ['[[u]]', '[[f]]', '[[t]]', '<<', '>>']
 REPLACE_NO_SPACE = re.compile("[`.;:!\'?,\"()\[\]]")
@@ -301,95 +458,270 @@ def clean_text(text, special_tokens=None):
     text = text.lower()
     return text
 
-def match_similar_span(mention, words):
-    span_to_find = mention[MEN_SPAN_STR_IDX]
-    span_to_find_length = len(span_to_find.split(' '))
-    if span_to_find_length == 1:
-        return (-1, -1)
-
-    spans = {}
-    for w in range(max(1, span_to_find_length - 2), min(len(words), span_to_find_length + 10)):
-        spans_w = { (i, i + w) : difflib.SequenceMatcher(None, span_to_find,' '.join(words[i : i + w])).ratio() for i in range(len(words) - w + 1) }
-        spans.update(spans_w)
-    m = max(spans, key=spans.get)
-    if spans[m] > 0.90:
-        print(f'Found most similar: {spans[m]}\n\"{words[m[0]:m[1]]}\"\n\"{span_to_find}\"')
-        return m
-    else:
-        print(f'NOT Found most similar: {spans[m]}\n\"{words[m[0]:m[1]]}\"\n\"{span_to_find}\"')
-
-    return (-1, -1)
-
-def match_mention(mention, words, words_str, suffix_map):
-    i = -1
-    span_str = mention[MEN_SPAN_STR_IDX].lower()
-    found_idxs = []
-    while i < len(words_str):
-        span_idx = words_str.find(span_str, i + 1, len(words_str))
-
-        if span_idx == -1:
-            break;
-
-        # if we match part of other words, continue
-        if span_idx > 0 and words_str[span_idx - 1] != ' ':
+# LCS length of a and b, bit-parallel over the chars of a (one big int row per char of b)
+def lcs_length(a, b):
+    masks = {}
+    for i, c in enumerate(a):
+        masks[c] = masks.get(c, 0) | (1 << i)
+    full = (1 << len(a)) - 1
+    row = full
+    for c in b:
+        matches = row & masks.get(c, 0)
+        row = ((row + matches) | (row - matches)) & full
+    return len(a) - bin(row).count('1')
+
+def char_ngrams(text, n=3):
+    return set(text[i : i + n] for i in range(len(text) - n + 1))
+
+# Matches the (clean_text) mentions of a paragraph to its words. The words are joined once, with the word index
+# every word starts at (a char offset) and a hash index of the word n-grams of up to NGRAM words, so a mention is
+# found by one lookup of its first words. A mention matches where its string starts at a word and ends at a word in
+# the joined words (also at the char before the end, as the str.find scan did), several matches are told apart by
+# how similar their words around are to the mention envs.
+class ParagraphMatcher(object):
+    NGRAM = 3
+    SIMILAR_RATIO = 0.9
+
+    def __init__(self, words):
+        self.words = words
+        self.words_str = ' '.join([w for w in words if w])
+        self.suffix_map = {}
+        offset = 0
+        for idx, word in enumerate(words):
+            if word:
+                self.suffix_map[offset] = idx
+                offset += len(word) + 1
+
+        self.tokens = self.words_str.split(' ')
+        self.token_offsets = list(itertools.accumulate([0] + [len(token) + 1 for token in self.tokens[:-1]]))
+        self.ngrams = {}
+        for i in range(len(self.tokens)):
+            for n in range(1, self.NGRAM + 1):
+                if i + n <= len(self.tokens):
+                    self.ngrams.setdefault(tuple(self.tokens[i : i + n]), []).append(i)
+        self.similar_text = None
+        self.similar_spans = {}
+
+    # the str.find scan, for the spans the n-grams do not cover (the empty span)
+    def _scan(self, span_str):
+        words_str = self.words_str
+        i = -1
+        found_idxs = []
+        while i < len(words_str):
+            span_idx = words_str.find(span_str, i + 1, len(words_str))
+            if span_idx == -1:
+                break
             i = span_idx
-            continue
-        if span_idx + len(span_str) < (len(words_str) - 1) and words_str[span_idx + len(span_str)] != ' ':
-            i = span_idx
-            continue
+            # if we match part of other words, continue
+            if span_idx > 0 and words_str[span_idx - 1] != ' ':
+                continue
+            if span_idx + len(span_str) < (len(words_str) - 1) and words_str[span_idx + len(span_str)] != ' ':
+                continue
+            found_idxs.append(span_idx)
+        return found_idxs
+
+    # char offsets of the matches of span_str
+    def find(self, span_str):
+        if not span_str:
+            return self._scan(span_str)
+        tokens = span_str.split(' ')
+        head = tuple(tokens[:self.NGRAM])
+        found_idxs = [self.token_offsets[i] for i in self.ngrams.get(head, [])
+                      if self.tokens[i + len(head) : i + len(tokens)] == tokens[len(head):]]
+        # a span ending at the char before the end is not checked to end at a word
+        last = len(self.words_str) - 1
+        span_idx = last - len(span_str)
+        if span_idx >= 0 and self.words_str.startswith(span_str, span_idx) and (span_idx == 0 or self.words_str[span_idx - 1] == ' '):
+            found_idxs.append(span_idx)
+        return sorted(set(found_idxs))
+
+    # the match whose left and right envs are the most similar to the mention envs (the first of the best)
+    def choose_by_env(self, mention, span_idxs, env_size=3):
+        print(f'Candidate: {mention}')
+        words_count = len(mention[MEN_SPAN_STR_IDX].split(' '))
+        candidates = []
+        for idx in span_idxs:
+            if idx in self.suffix_map:
+                start = self.suffix_map[idx]
+                candidates.append((start, start + (words_count - 1)))
+        chosen = None
+        if candidates:
+            scores = np.zeros(len(candidates))
+            for env_idx, env in ((MEN_RENV_IDX, lambda start, end : self.words[end + 1 : end + 1 + env_size]),
+                                 (MEN_LENV_IDX, lambda start, end : self.words[max(0, start - env_size) : start])):
+                matcher = difflib.SequenceMatcher(None, '', mention[env_idx])
+                env_scores = []
+                for start, end in candidates:
+                    matcher.set_seq1(clean_text(' '.join(env(start, end))))
+                    env_scores.append(matcher.ratio())
+                scores += np.array(env_scores)
+            chosen = candidates[int(np.argmax(scores))]
+        print('====')
+        print(mention[MEN_LENV_IDX])
+        print(mention[MEN_RENV_IDX])
+        print(mention[MEN_SPAN_STR_IDX])
+        print(chosen)
+        print('====')
+        return chosen
+
+    # The window of words (of about the mention words count) most similar to a mention of more than one word, if
+    # their 2 * LCS / (chars of both) is above SIMILAR_RATIO. A window is skipped when its length, or the count of
+    # its text positions starting a span char trigram, cannot get there: an edit loses at most 3 trigrams and
+    # 2 * LCS / (m + n) > r leaves less than (1 - r)(m + n) edits. The window text is a slice of all the words joined
+    # (empty words included, they join to double spaces), so the positions are counted with one prefix sum.
+    # Results are cached by span.
+    def match_similar(self, mention):
+        span_str = mention[MEN_SPAN_STR_IDX]
+        if span_str not in self.similar_spans:
+            self.similar_spans[span_str] = self._match_similar(span_str)
+        return self.similar_spans[span_str]
+
+    def _match_similar(self, span_str):
+        words = self.words
+        span_to_find_length = len(span_str.split(' '))
+        if span_to_find_length == 1:
+            return None
+        if self.similar_text is None:
+            self.similar_text = (' '.join(words), list(itertools.accumulate([0] + [len(w) + 1 for w in words])))
+        text, starts = self.similar_text
+        span_trigrams = char_ngrams(span_str)
+        hits = [0]
+        for p in range(len(text)):
+            hits.append(hits[-1] + int(text[p : p + 3] in span_trigrams))
+
+        m = len(span_str)
+        ratio = self.SIMILAR_RATIO
+        best, best_window = -1, None
+        for w in range(max(1, span_to_find_length - 2), min(len(words), span_to_find_length + 10)):
+            for i in range(len(words) - w + 1):
+                begin, end = starts[i], starts[i + w] - 1
+                n = end - begin
+                if 2 * min(m, n) <= ratio * (m + n):
+                    continue
+                window_hits = hits[max(begin, end - 2)] - hits[begin]
+                if window_hits < len(span_trigrams) - 3 * int((1 - ratio) * (m + n)):
+                    continue
+                score = 2 * lcs_length(span_str, ' '.join(words[i : i + w])) / (m + n)
+                if score > best:
+                    best, best_window = score, (i, i + w - 1)
+        if best > ratio:
+            print(f'Found most similar: {best}\n\"{words[best_window[0] : best_window[1] + 1]}\"\n\"{span_str}\"')
+            return best_window
+        print(f'NOT Found most similar: {best}\n\"{span_str}\"')
+        return None
 
-        found_idxs.append(span_idx)
-        i = span_idx
-    return found_idxs
+    # (start, end) word span of a mention, None if it is not found
+    def match(self, mention):
+        span_idxs = self.find(mention[MEN_SPAN_STR_IDX].lower())
+        if len(span_idxs) == 0:
+            start, end = self.match_similar(mention) or (-1, -1)
+        elif len(span_idxs) == 1:
+            start = span_idxs[0]
+            start = self.suffix_map[start]
+            words_count = len(mention[MEN_SPAN_STR_IDX].split(' '))
+            end = start + (words_count - 1)
+        else: # len > 1
+            result = self.choose_by_env(mention, span_idxs)
+            if result is None:
+                start, end = -1, -1
+            else:
+                start, end = result
+        if start == -1 or end == -1:
+            return None
+        return (start, end)
 
 def match_mention_to_word(mention ,words):
-    clean_words_str = ' '.join([w for w in words if w])
-    suffix_map = create_suffix_map(words, clean_words_str)
-    span_idxs = match_mention(mention, words, clean_words_str, suffix_map)
-    if len(span_idxs) == 0:
-        #start, end = match_similar_span(mention, words)
-        start, end = (-1, -1)
-    elif len(span_idxs) == 1:
-        start = span_idxs[0]
-        start = suffix_map[start]
-        words_count = len(mention[MEN_SPAN_STR_IDX].split(' '))
-        end = start + (words_count - 1)
-    else: # len > 1
-        result = choose_by_env(mention, span_idxs, suffix_map, words)
-        if result is None:
-            start, end = -1, -1
-        else:
-            start, end = result
-    if start == -1 or end == -1:
-        return None
-    return (start, end)
+    return ParagraphMatcher(words).match(mention)
+
+# (start, end) of the most similar window with an exclusive end, (-1, -1) if there is none
+def match_similar_span(mention, words):
+    window = ParagraphMatcher(words).match_similar(mention)
+    if window is None:
+        return (-1, -1)
+    return (window[0], window[1] + 1)
+
+MARKERS_RE = re.compile('<<|>>|\[\[[uft]\]\]')
+MENTION_ENVS_RE = re.compile(CAPTURE_MENTIONS_ENVS_RE)
+
+# lowercased, without accents and spaces, as the tokenizers may decode a word
+def fold_text(text):
+    return ''.join(c for c in unicodedata.normalize('NFD', text.lower()) if not c.isspace() and not unicodedata.combining(c))
+
+# The paragraph words as one folded text, with the word of every character and the text offset every word starts at
+class WordsText(object):
+    def __init__(self, words):
+        texts = [fold_text(word) for word in words]
+        self.text = ''.join(texts)
+        self.owners = [word_index for word_index, text in enumerate(texts) for _ in text]
+        self.starts = list(itertools.accumulate([0] + [len(text) for text in texts]))
+
+    # Walks an output (a copy of the words with markers) with the words in lockstep, skipping the markers and the
+    # spaces. Returns the text offset of every output character, None for markers, spaces and everything after the
+    # output stops copying the words.
+    def align(self, output_str):
+        offsets = [None] * len(output_str)
+        offset = 0
+        segments = [(0, len(output_str))]
+        if output_str:
+            bounds = [0] + [i for m in MARKERS_RE.finditer(output_str) for i in m.span()] + [len(output_str)]
+            segments = zip(bounds[::2], bounds[1::2])
+        for start, end in segments:
+            for position in range(start, end):
+                text = fold_text(output_str[position])
+                if not text:
+                    continue
+                if not self.text.startswith(text, offset):
+                    return offsets
+                offsets[position] = offset
+                offset += len(text)
+        return offsets
+
+    # word span (start, end) of a mention of output_str (extract_mentions_with_env) given the output offsets, None
+    # when its span is not a copy of whole words
+    def mention_span(self, mention, output_str, offsets):
+        m = MENTION_ENVS_RE.match(output_str, mention[MEN_SPAN_RANGE_IDX][0])
+        if m is None:
+            return None
+        positions = [position for position in range(m.start('span'), m.end('span')) if fold_text(output_str[position])]
+        if not positions or any(offsets[position] is None for position in positions):
+            return None
+        first = offsets[positions[0]]
+        last = offsets[positions[-1]] + len(fold_text(output_str[positions[-1]])) - 1
+        start, end = self.owners[first], self.owners[last]
+        if first != self.starts[start] or last != self.starts[end + 1] - 1:
+            return None
+        return (start, end)
 
 def create_seperate_clusters(pred_obj_clusters_golden_idxs):
-    clusters = [set(list(items) + [key]) for key, items in pred_obj_clusters_golden_idxs.items()]
-    i = 0
-    while i < len(clusters):
-        j = i + 1
-        while j < len(clusters):
-            if clusters[i] & clusters[j]:
-                clusters[i] = clusters[i].union(clusters[j])
-                del clusters[j]
-                j = i + 1
-                continue
-            j += 1
-        i += 1
-    clusters = [list(c) for c in clusters]
-    return clusters
+    return merge_clusters([key] + list(items) for key, items in pred_obj_clusters_golden_idxs.items())
 
-def predict_final_clusters(pred_obj_clusters, words):
+# Word spans of the predicted clusters. Given the outputs the mentions come from (the mentions stage output and the
+# cluster stage output of every mention) a mention is aligned by WordsText, the string matching of
+# a ParagraphMatcher of the paragraph is left for the mentions of outputs that stopped copying the paragraph.
+def predict_final_clusters(pred_obj_clusters, words, model_output_str=None, cluster_pred_outputs=None):
     unmatched_mentions = []
     pred_obj_clusters_golden_idxs = {}
+    words_text = WordsText(words)
+    alignments = {}
+    def align(mention, output_str):
+        if output_str is None:
+            return None
+        if output_str not in alignments:
+            alignments[output_str] = words_text.align(output_str)
+        return words_text.mention_span(mention, output_str, alignments[output_str])
+    string_matched = []
+
     words = [clean_text(w) for w in words]
+    matcher = ParagraphMatcher(words)
     for main_mention in pred_obj_clusters.keys():
         # clean text
         clean_main_mention = (clean_text(main_mention[MEN_LENV_IDX]), clean_text(main_mention[MEN_RENV_IDX]), clean_text(main_mention[MEN_SPAN_STR_IDX]),
                               main_mention[MEN_SPAN_RANGE_IDX], main_mention[MEN_CLUSTER_TAG_IDX])
 
-        match_result = match_mention_to_word(clean_main_mention, words)
+        match_result = align(main_mention, model_output_str)
+        if match_result is None:
+            string_matched.append(clean_main_mention)
+            match_result = matcher.match(clean_main_mention)
         if match_result is None:
             print(f'=====================')
             print(f'Could not find mention')
@@ -404,7 +736,10 @@ def predict_final_clusters(pred_obj_clusters, words):
         for mention in pred_obj_clusters[main_mention]:
             clean_mention = (clean_text(mention[MEN_LENV_IDX]), clean_text(mention[MEN_RENV_IDX]), clean_text(mention[MEN_SPAN_STR_IDX]),
                              mention[MEN_SPAN_RANGE_IDX], mention[MEN_CLUSTER_TAG_IDX])
-            match_result = match_mention_to_word(clean_mention, words)
+            match_result = align(mention, (cluster_pred_outputs or {}).get(main_mention))
+            if match_result is None:
+                string_matched.append(clean_mention)
+                match_result = matcher.match(clean_mention)
             if match_result is None:
                 print(f'=====================')
                 print(f'Could not find mention')
@@ -416,7 +751,9 @@ def predict_final_clusters(pred_obj_clusters, words):
             pred_obj_clusters_golden_idxs[main_key].append((start, end))
 
     final_pred_clusters = create_seperate_clusters(pred_obj_clusters_golden_idxs)
-    clean_words_str = ' '.join([w for w in words if w])
+    clean_words_str = matcher.words_str
+    mentions_count = len(pred_obj_clusters) + sum(len(mentions) for mentions in pred_obj_clusters.values())
+    print(f'Aligned mentions: {mentions_count - len(string_matched)} / {mentions_count}')
     return final_pred_clusters, unmatched_mentions, clean_words_str
 
 
@@ -440,42 +777,222 @@ def print_results(final_pred_clusters, golden_clusters, words, unmatched_mention
         print(mention)
     print('=======================\n')
 
-def process_doc_key_examples(doc_key_dir, current_doc_key, builder, tokenizer, model, model_type, config, beam_size, tag_only_clusters=False):
-    cur_paragraph_examples = [(idx, doc_key, paragraph_id, new_words, new_clusters, new_speakers, new_conll_lines, index_shift) \
-                               for (idx, doc_key, paragraph_id, new_words, new_clusters, new_speakers, new_conll_lines, index_shift) \
-                               in builder.paragraph_examples if doc_key == current_doc_key]
+# A paragraph on its way through the model: the mentions prompt first (unless the mentions are given, as with
+# --tag_only_clusters), then the cluster example of every predicted mention. prompts() are the inputs the paragraph
+# waits for and receive() takes their outputs in the same order, the results are saved once the clusters are tagged.
+# With skip_clustered the cluster examples go one at a time, in the mentions order, and a mention an earlier output
+# tagged [[t]] is already in a cluster, so its example is skipped (but for a spot_check share of them, at random).
+class ParagraphInference(object):
+    def __init__(self, doc_key, paragraph_id, words, golden_clusters, fingerprint, results_path, model_output_str=None,
+                 skip_clustered=False, spot_check=0.0):
+        self.doc_key = doc_key
+        self.paragraph_id = paragraph_id
+        self.words = words
+        self.golden_clusters = golden_clusters
+        self.fingerprint = fingerprint
+        self.results_path = results_path
+        self.model_output_str = model_output_str
+        self.skip_clustered = skip_clustered
+        self.spot_check = spot_check
+        self.random = random.Random(f'{doc_key}:{paragraph_id}')
+        self.done = False
+        if model_output_str is not None:
+            self._start_clusters()
+
+    def _start_clusters(self):
+        self.model_output_mentions, self.true_cluster_sentences = cluster_examples(self.model_output_str)
+        self.cluster_outputs = [None] * len(self.true_cluster_sentences)
+        self.pending = list(range(len(self.true_cluster_sentences)))
+        self.clustered = set()
+        self.skipped = 0
+        self.wave = self._next_wave()
+        if not self.wave:
+            self._finish(self.cluster_outputs)
+
+    # the mentions whose cluster examples are prompted next
+    def _next_wave(self):
+        if not self.skip_clustered:
+            wave, self.pending = self.pending, []
+            return wave
+        while self.pending:
+            j = self.pending.pop(0)
+            if j not in self.clustered or self.random.random() < self.spot_check:
+                return [j]
+            print(f'Skip Mention ({j}): {self.model_output_mentions[j]}')
+            self.skipped += 1
+        return []
+
+    # the mentions a cluster output tags [[t]], by their order when the output has all the mentions. Otherwise the
+    # k-th tagged occurrence of a span string is the k-th mention with that string, only for the strings the output
+    # has as many times as the mentions do. The mentions of the other strings ("he" dropped or added once) are left
+    # to their own prompts, marking the wrong "he" would skip a prompt the mention needs.
+    def _cluster_members(self, model_output_str):
+        tagged_mentions = extract_mentions_with_env(model_output_str)
+        if len(tagged_mentions) == len(self.model_output_mentions):
+            return [j for j, m in enumerate(tagged_mentions) if m[MEN_CLUSTER_TAG_IDX] == 't']
+        occurrences = {}
+        for j, m in enumerate(self.model_output_mentions):
+            occurrences.setdefault(m[MEN_SPAN_STR_IDX], []).append(j)
+        tags = {}
+        for m in tagged_mentions:
+            tags.setdefault(m[MEN_SPAN_STR_IDX], []).append(m[MEN_CLUSTER_TAG_IDX] == 't')
+        members = []
+        for span, span_tags in tags.items():
+            if len(span_tags) == len(occurrences.get(span, ())):
+                members.extend(j for j, tag in zip(occurrences[span], span_tags) if tag)
+        return sorted(members)
+
+    def cluster_stage(self):
+        return self.model_output_str is not None
+
+    def prompts(self):
+        if self.model_output_str is None:
+            return [' '.join(self.words).lower()]
+        return [self.true_cluster_sentences[j] for j in self.wave]
+
+    def receive(self, model_output_strs, tag_scores=None):
+        if self.model_output_str is None:
+            self.model_output_str = model_output_strs[0]
+            print(f'Model Output {self.doc_key} : {self.paragraph_id}')
+            print(self.model_output_str)
+            self._start_clusters()
+            return
+
+        if tag_scores is not None:
+            for j, scores in zip(self.wave, tag_scores):
+                print(f'Tag Scores ({j}): {self.model_output_mentions[j][MEN_SPAN_STR_IDX]} : ' + ' '.join(f'{score:.3f}' for score in scores))
+        for j, model_output_str in zip(self.wave, model_output_strs):
+            self.cluster_outputs[j] = model_output_str
+            if self.skip_clustered:
+                self.clustered.update(self._cluster_members(model_output_str))
+        self.wave = self._next_wave()
+        if not self.wave:
+            if self.skip_clustered:
+                print(f'Cluster prompts {self.doc_key} : {self.paragraph_id} - {len(self.cluster_outputs) - self.skipped} / {len(self.cluster_outputs)}')
+            self._finish(self.cluster_outputs)
+
+    def _finish(self, model_output_strs):
+        pred_obj_clusters, cluster_pred_outputs = tag_clusters(self.model_output_mentions, model_output_strs)
+        final_pred_clusters, unmatched_mentions, clean_words_str = predict_final_clusters(pred_obj_clusters, self.words, self.model_output_str,
+                                                                                          cluster_pred_outputs)
+
+        with open(self.results_path, 'wb') as f:
+            results = (pred_obj_clusters, cluster_pred_outputs, final_pred_clusters, self.fingerprint, unmatched_mentions, self.words, clean_words_str)
+            pickle.dump(results, f)
+            print(f'Saved {self.doc_key} : {self.paragraph_id} - {self.results_path}')
+
+        print_results(final_pred_clusters, self.golden_clusters, self.words, unmatched_mentions)
+        self.done = True
+
+# Runs the prompts of many paragraphs together. Every round takes the pending prompts of all the paragraphs in flight,
+# mention and cluster prompts alike, sorts them by length and cuts them into batches of at most batch_size prompts
+# and max_batch_tokens tokens (prompts x longest prompt). The outputs go back to their paragraphs, finished
+# paragraphs leave and new ones join up to window paragraphs in flight. With score_tags the cluster prompts are
+# batched apart and tagged by score_cluster_tags instead of generate(), with copy_mentions the mentions prompts are
+# batched apart and decoded by CopyMarkersLogitsProcessor. The prompts and the model calls (batches) are counted.
+class InferenceScheduler(object):
+    def __init__(self, model, tokenizer, beam_size, batch_size=16, max_batch_tokens=4096, window=64, score_tags=False,
+                 copy_mentions=False):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.beam_size = beam_size
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.window = window
+        self.score_tags = score_tags
+        self.copy_mentions = copy_mentions
+        self.word_pieces = WordPieces(tokenizer)
+        self.mention_prompts = 0
+        self.cluster_prompts = 0
+        self.model_calls = 0
+
+    # consecutive runs of the prompts sorted by length
+    def _batches(self, requests):
+        batch = []
+        for length, request in sorted(requests, key=lambda request : request[0]):
+            if batch and (len(batch) == self.batch_size or (len(batch) + 1) * length > self.max_batch_tokens):
+                yield batch
+                batch = []
+            batch.append(request)
+        if batch:
+            yield batch
+
+    def _round(self, paragraphs):
+        outputs = [[None] * len(paragraph.prompts()) for paragraph in paragraphs]
+        scores = [[None] * len(paragraph.prompts()) for paragraph in paragraphs]
+        requests = []
+        copied_requests = []
+        scored_requests = []
+        for i, paragraph in enumerate(paragraphs):
+            for j, prompt in enumerate(paragraph.prompts()):
+                length = min(len(self.tokenizer.encode(prompt)), 128)
+                if paragraph.cluster_stage():
+                    self.cluster_prompts += 1
+                else:
+                    self.mention_prompts += 1
+                if self.score_tags and paragraph.cluster_stage():
+                    scored_requests.append((length, (i, j, prompt)))
+                elif self.copy_mentions and not paragraph.cluster_stage():
+                    copied_requests.append((length, (i, j, prompt)))
+                else:
+                    requests.append((length, (i, j, prompt)))
+        for copy_input, generated_requests in ((False, requests), (True, copied_requests)):
+            for batch in self._batches(generated_requests):
+                model_output_strs = execute_model_batch([prompt for _, _, prompt in batch], self.model, self.tokenizer, self.beam_size, len(batch),
+                                                        copy_input=copy_input, word_pieces=self.word_pieces)
+                self.model_calls += 1
+                for (i, j, _), model_output_str in zip(batch, model_output_strs):
+                    outputs[i][j] = model_output_str
+        for batch in self._batches(scored_requests):
+            model_output_strs, tag_scores = score_cluster_tags([prompt for _, _, prompt in batch], self.model, self.tokenizer, len(batch))
+            self.model_calls += 1
+            for (i, j, _), model_output_str, prompt_scores in zip(batch, model_output_strs, tag_scores):
+                outputs[i][j] = model_output_str
+                scores[i][j] = prompt_scores
+        print(f'Round: {len(paragraphs)} paragraphs, {len(requests)} generated prompts, {len(copied_requests)} copied prompts, ' \
+              f'{len(scored_requests)} scored prompts')
+        for paragraph, paragraph_outputs, paragraph_scores in zip(paragraphs, outputs, scores):
+            paragraph.receive(paragraph_outputs, paragraph_scores if self.score_tags and paragraph.cluster_stage() else None)
+
+    def run(self, paragraphs):
+        self.model.config.no_repeat_ngram_size = None
+        paragraphs = iter(paragraphs)
+        in_flight = []
+        while True:
+            in_flight = [paragraph for paragraph in in_flight if not paragraph.done]
+            for paragraph in itertools.islice(paragraphs, self.window - len(in_flight)):
+                if not paragraph.done:
+                    in_flight.append(paragraph)
+            if not in_flight:
+                break
+            self._round(in_flight)
+
+# The paragraphs of current_doc_key that have no inference results yet (or results of other words)
+def doc_key_paragraphs(doc_key_dir, current_doc_key, builder, tag_only_clusters=False, skip_clustered=False, spot_check=0.0):
+    cur_paragraph_examples = builder.paragraph_words(current_doc_key)
     print(f'Infer {current_doc_key} : {doc_key_dir}')
     meta_json = {'doc_key' : current_doc_key, 
                  'paragraphs_count' : len(cur_paragraph_examples),
-                 'paragraphs' : [ item[2] for item in cur_paragraph_examples]}
+                 'paragraphs' : [ item[0] for item in cur_paragraph_examples]}
     meta_path = os.path.join(doc_key_dir, 'meta.json')
     with open(meta_path, 'wb') as f:
         f.write(json.dumps(meta_json).encode('ascii'))
 
-    cur_paragraph_examples.sort(key=lambda x : x[2])
-    for i, (_, doc_key, paragraph_id, sentences, golden_clusters, _, _, _) in enumerate(cur_paragraph_examples):
+    doc_key = current_doc_key
+    for i, (paragraph_id, sentences, golden_clusters) in enumerate(cur_paragraph_examples):
         print()
         print(f'Try Infering {doc_key} : {paragraph_id}')
         words = flatten_list_of_lists(sentences)
         words = [w.lower() for w in words]
-        try:
-            words_str = ' '.join(words)
-        except UnicodeEncodeError:
-            print('Unicode is not supported')
-            continue
-
-        try:
-            input_words_str_md5 = hashlib.md5(words_str.encode('ascii')).hexdigest()
-        except:
-            input_words_str_md5 = hashlib.md5(words_str.encode('utf-8')).hexdigest()
+        fingerprint = builder.paragraph_fingerprint(doc_key, paragraph_id)
 
         results_path = os.path.join(doc_key_dir, f'paragraph_{paragraph_id}.pkl')
         if os.path.exists(results_path):
             try:
                 with open(results_path, 'rb') as f:
                     results = pickle.load(f)
-                pred_obj_clusters, cluster_pred_outputs, final_pred_clusters, pickled_input_words_str_md5, unmatched_mentions, words, clean_words_str = results
-                if pickled_input_words_str_md5 == input_words_str_md5:
+                if same_paragraph(fingerprint, results[3], sentences):
+                    pred_obj_clusters, cluster_pred_outputs, final_pred_clusters, _, unmatched_mentions, words, clean_words_str = results
                     print(f'Loaded {doc_key} : {paragraph_id}')
                     print_results(final_pred_clusters, golden_clusters, words, unmatched_mentions)
                     continue
@@ -487,23 +1004,13 @@ def process_doc_key_examples(doc_key_dir, current_doc_key, builder, tokenizer, m
         if tag_only_clusters:
             print(f'NOTE!!! Using Pre-defined mentions!')
             # Get pre-defined mentions from the builder. we want to check only the clusters tagging.
-            stub_model_output_str = builder.mentions_df.loc[builder.mentions_df['doc_key'] == doc_key].loc[builder.mentions_df['paragraph_id'] == paragraph_id]['output_str'].tolist()[0]
-
-        pred_obj_clusters, cluster_pred_outputs = inference_example(model, tokenizer, words, beam_size, model_output_str=stub_model_output_str)
-        final_pred_clusters, unmatched_mentions, clean_words_str = predict_final_clusters(pred_obj_clusters, words)
-
-        with open(results_path, 'wb') as f:
-            results = (pred_obj_clusters, cluster_pred_outputs, final_pred_clusters, input_words_str_md5, unmatched_mentions, words, clean_words_str)
-            pickle.dump(results, f)
-            print(f'Saved {doc_key} : {paragraph_id} - {results_path}')
-
-        print_results(final_pred_clusters, golden_clusters, words, unmatched_mentions)
-    
-    print(f'Finished Infereing {current_doc_key}')
-    return
+            stub_model_output_str = builder.mention_target(doc_key, paragraph_id)
+        yield ParagraphInference(doc_key, paragraph_id, words, golden_clusters, fingerprint, results_path, model_output_str=stub_model_output_str,
+                                 skip_clustered=skip_clustered, spot_check=spot_check)
 
 
-def generate_inference_results(builder, tokenizer, model, model_type, config, beam_size, done_keys, tag_only_clusters=False):
+def generate_inference_results(builder, tokenizer, model, model_type, config, beam_size, done_keys, tag_only_clusters=False, batch_size=16,
+                               max_batch_tokens=4096, window=64, score_tags=False, copy_mentions=False, skip_clustered=False, spot_check=0.0):
     results = []
     proj_dir = r'.'
     infer_main_dir = os.path.join(proj_dir, 'inference_results')
@@ -514,19 +1021,25 @@ def generate_inference_results(builder, tokenizer, model, model_type, config, be
         pass
 
     # first, update all keys that already have a dir.
-    doc_keys = list(builder.document_examples.keys())
+    doc_keys = list(builder.doc_keys)
     #doc_keys = list(set(doc_keys) - set(done_keys))
 
     # process keys who dont have a directory
-    for current_doc_key in doc_keys:
-        current_doc_key_dirname = current_doc_key.replace('/', '#')
-        doc_key_dir = os.path.join(infer_dir, current_doc_key_dirname)
-        if not os.path.isdir(doc_key_dir):
-            os.mkdir(doc_key_dir)
-            print(f'Create {current_doc_key} dir: {doc_key_dir}')
-        else:
-            print(f'Dir exists {current_doc_key} : {doc_key_dir}')
-        process_doc_key_examples(doc_key_dir, current_doc_key, builder, tokenizer, model, model_type, config, beam_size, tag_only_clusters=tag_only_clusters)
+    def paragraphs():
+        for current_doc_key in doc_keys:
+            current_doc_key_dirname = current_doc_key.replace('/', '#')
+            doc_key_dir = os.path.join(infer_dir, current_doc_key_dirname)
+            if not os.path.isdir(doc_key_dir):
+                os.mkdir(doc_key_dir)
+                print(f'Create {current_doc_key} dir: {doc_key_dir}')
+            else:
+                print(f'Dir exists {current_doc_key} : {doc_key_dir}')
+            yield from doc_key_paragraphs(doc_key_dir, current_doc_key, builder, tag_only_clusters=tag_only_clusters,
+                                          skip_clustered=skip_clustered, spot_check=spot_check)
+
+    scheduler = InferenceScheduler(model, tokenizer, beam_size, batch_size=batch_size, max_batch_tokens=max_batch_tokens, window=window, score_tags=score_tags,
+                                   copy_mentions=copy_mentions)
+    scheduler.run(paragraphs())
 
 def main():
     parser = argparse.ArgumentParser(add_help=True)
@@ -536,11 +1049,24 @@ def main():
     parser.add_argument('--dropout', type=float)
     parser.add_argument('--monitor', type=bool, default=False)
     parser.add_argument('--tag_only_clusters', type=bool, default=False)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--max_batch_tokens', type=int, default=4096)
+    parser.add_argument('--window', type=int, default=64)
+    parser.add_argument('--score_tags', type=bool, default=False)
+    parser.add_argument('--copy_mentions', type=bool, default=False)
+    parser.add_argument('--skip_clustered', type=bool, default=False)
+    parser.add_argument('--spot_check', type=float, default=0.0)
     args = parser.parse_args(sys.argv[1:])
     config = f'{args.dropout}'
     infer_config = config
     if args.tag_only_clusters:
         infer_config = f'{args.dropout}_clusters_prediction_only'
+    if args.score_tags:
+        infer_config = f'{infer_config}_scored_tags'
+    if args.copy_mentions and not args.tag_only_clusters:
+        infer_config = f'{infer_config}_copied_mentions'
+    if args.skip_clustered:
+        infer_config = f'{infer_config}_skip_clustered_{args.spot_check}'
 
     if args.monitor:
         CUDA_DEVICE = torch.device('cpu')
@@ -562,13 +1088,15 @@ def main():
     except:
         pass
 
-    done_keys, ratio = monitor_inference(builder.document_examples.keys(), infer_dir)
+    done_keys, ratio = monitor_inference(builder.doc_keys, infer_dir)
     if args.monitor:
         while True:
             time.sleep(60)
-            done_keys, ratio = monitor_inference(builder.document_examples.keys(), infer_dir)
+            done_keys, ratio = monitor_inference(builder.doc_keys, infer_dir)
     else:
         done_keys = []
-        generate_inference_results(builder, tokenizer, model, args.model, infer_config, args.beam, done_keys, tag_only_clusters=args.tag_only_clusters)
+        generate_inference_results(builder, tokenizer, model, args.model, infer_config, args.beam, done_keys, tag_only_clusters=args.tag_only_clusters, batch_size=args.batch_size,
+                                   max_batch_tokens=args.max_batch_tokens, window=args.window, score_tags=args.score_tags,
+                                   copy_mentions=args.copy_mentions, skip_clustered=args.skip_clustered, spot_check=args.spot_check)
 if __name__ == '__main__':
     main()
@@ -14,7 +14,7 @@ from datasets import Dataset, load_metric
 from utils import extract_mentions_to_predicted_clusters_from_clusters
 from cores_tokens import encode
 from consts import SPEAKER_START, SPEAKER_END, NULL_ID_FOR_COREF
-from cores_tokens_test import CoresDatasetPreProcessorTest
+from cores_tokens_test import CoresDatasetPreProcessorTest, load_test_builder
 
 import torch
 import pandas as pd
@@ -43,8 +43,7 @@ def load_pickles(dataset_builder_path):
         sys.exit(0)
 
     print("Loading Builder")
-    with open(dataset_builder_path, 'rb') as f:
-        builder = pickle.load(f)
+    builder = load_test_builder(dataset_builder_path)
 
     return builder
 
@@ -57,11 +56,21 @@ def eval():
     parser.add_argument('--dropout', type=float)
     parser.add_argument('--official', type=bool, default=True)
     parser.add_argument('--tag_only_clusters', type=bool, default=False)
+    parser.add_argument('--score_tags', type=bool, default=False)
+    parser.add_argument('--copy_mentions', type=bool, default=False)
+    parser.add_argument('--skip_clustered', type=bool, default=False)
+    parser.add_argument('--spot_check', type=float, default=0.0)
     args = parser.parse_args(sys.argv[1:])
     config = f'{args.dropout}'
     infer_config = config
     if args.tag_only_clusters:
         infer_config = f'{args.dropout}_clusters_prediction_only'
+    if args.score_tags:
+        infer_config = f'{infer_config}_scored_tags'
+    if args.copy_mentions and not args.tag_only_clusters:
+        infer_config = f'{infer_config}_copied_mentions'
+    if args.skip_clustered:
+        infer_config = f'{infer_config}_skip_clustered_{args.spot_check}'
 
     proj_dir = r'.'
     infer_main_dir = os.path.join(proj_dir, 'inference_results')
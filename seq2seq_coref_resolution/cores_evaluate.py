@@ -1,6 +1,6 @@
 from transformers import BertTokenizerFast
 from transformers import T5Tokenizer
-from cores_tokens import CoresDatasetPreProcessor
+from cores_tokens import CoresDatasetPreProcessor, load_builder, as_dataset, cluster_example
 import datasets
 from datasets import Dataset, concatenate_datasets
 import pickle
@@ -55,8 +55,9 @@ def main():
         print(f'Please generate {dataset_builder_path}')
         sys.exit(0)
 
-    with open(dataset_builder_path, 'rb') as f:
-        builder = pickle.load(f)
+    builder = load_builder(dataset_builder_path)
+    mentions_df = as_dataset(builder.mentions_df)
+    clusters_df = as_dataset(builder.clusters_df)
 
     config = f'{args.dropout}'
     checkpoints_dir = os.path.join(proj_dir, 'training_results', model_type, config)
@@ -89,8 +90,9 @@ def main():
         invalid_examples = []
         for i in range(3):
             print(f'cluster {i}')
-            input_str = builder.clusters_df['input_str'][i]
-            y = builder.clusters_df['output_str'][i]
+            example = cluster_example(mentions_df, clusters_df[i])
+            input_str = example['input_str']
+            y = example['output_str']
             print('Input')
             print(input_str)
             print('Target')
@@ -100,7 +102,7 @@ def main():
             model.config.max_length = 128
             print(f'min length: {model.config.min_length}')
             input_str = [input_str,]
-            inputs  = tokenizer(input_str,  padding="max_length", truncation=True, max_length=128)
+            inputs  = tokenizer(input_str,  padding="longest", truncation=True, max_length=128)
             outputs = model.generate(torch.tensor(inputs.input_ids), attention_mask=torch.tensor(inputs.attention_mask),
                                      num_beams=5, num_return_sequences=1, no_repeat_ngram_size=2)
             output_str = tokenizer.batch_decode(outputs, skip_special_tokens=True)
@@ -129,8 +131,8 @@ def main():
 
         for i in range(3):
             print(f'mention: {i}')
-            input_str = builder.mentions_df['input_str'][i]
-            y = builder.mentions_df['output_str'][i]
+            input_str = mentions_df[i]['input_str']
+            y = mentions_df[i]['output_str']
             print('Input')
             print(input_str)
             print('Target')
@@ -140,7 +142,7 @@ def main():
             model.config.max_length = 128
             print(f'min length: {model.config.min_length}')
             input_str = [input_str,]
-            inputs  = tokenizer(input_str,  padding="max_length", truncation=True, max_length=128)
+            inputs  = tokenizer(input_str,  padding="longest", truncation=True, max_length=128)
             outputs = model.generate(torch.tensor(inputs.input_ids), attention_mask=torch.tensor(inputs.attention_mask),
                                      num_beams=beam_size ,num_return_sequences=1, no_repeat_ngram_size=0)
                                      #return_dict_in_generate=True, output_scores=True)
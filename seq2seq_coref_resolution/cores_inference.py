@@ -184,7 +184,7 @@ def create_suffix_map(words, words_str):
 
 def execute_model(input_str, model, tokenizer, beam_size):
     input_str = [input_str,]
-    inputs  = tokenizer(input_str,  padding="max_length", truncation=True, max_length=128)
+    inputs  = tokenizer(input_str,  padding="longest", truncation=True, max_length=128)
     model_outputs = model.generate(torch.tensor(inputs.input_ids), attention_mask=torch.tensor(inputs.attention_mask), num_beams=beam_size ,num_return_sequences=1, no_repeat_ngram_size=0) #return_dict_in_generate=True, output_scores=True)
     model_output_str = tokenizer.batch_decode(model_outputs, skip_special_tokens=True)
     model_output_str = model_output_str[0]
@@ -0,0 +1,93 @@
+import io
+import os
+import sys
+import time
+import random
+import argparse
+import contextlib
+
+import numpy as np
+import torch
+
+import cores_dir_inference
+from cores_dir_inference import load_pickles, load_tokenizer, execute_model_batch, cluster_examples
+from cores_tokens_test import load_test_builder
+from utils import flatten_list_of_lists
+
+# The prompts inference sends to the model: the mentions prompt of every paragraph and, from the gold mentions, the
+# cluster example of every mention (the --tag_only_clusters prompts)
+def builder_prompts(builder):
+    mention_prompts = []
+    cluster_prompts = []
+    for doc_key in builder.doc_keys:
+        for paragraph_id, sentences, _ in builder.paragraph_words(doc_key):
+            mention_prompts.append(' '.join(flatten_list_of_lists(sentences)).lower())
+            with contextlib.redirect_stdout(io.StringIO()):
+                _, true_cluster_sentences = cluster_examples(builder.mention_target(doc_key, paragraph_id))
+            cluster_prompts.extend(true_cluster_sentences)
+    return mention_prompts, cluster_prompts
+
+def print_lengths(name, lengths):
+    lengths = np.array(lengths)
+    print(f'{name}: {len(lengths)} prompts, mean length {lengths.mean():.1f}, ' \
+          f'p50 {np.percentile(lengths, 50):.0f} p90 {np.percentile(lengths, 90):.0f} max {lengths.max()}')
+
+# Encoder positions of the batches of lengths with every prompt padded to 128 and with every batch padded to its
+# longest prompt, in the file order and sorted by length (InferenceScheduler)
+def print_positions(name, lengths, batch_size):
+    def padded(lengths):
+        return sum(len(batch) * max(batch) for batch in [lengths[i : i + batch_size] for i in range(0, len(lengths), batch_size)])
+    max_length = 128 * len(lengths)
+    in_order = padded(lengths)
+    by_length = padded(sorted(lengths))
+    print(f'{name}: encoder positions padded to 128 = {max_length}, to longest = {in_order} ({in_order / max_length:.2f}), ' \
+          f'to longest sorted by length = {by_length} ({by_length / max_length:.2f})')
+
+def time_generation(prompts, model, tokenizer, beam_size, batch_size, padding):
+    start = time.time()
+    with torch.no_grad():
+        outputs = execute_model_batch(prompts, model, tokenizer, beam_size, batch_size=batch_size, padding=padding)
+    return time.time() - start, outputs
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('--model', type=str)
+    parser.add_argument('--builder', type=str)
+    parser.add_argument('--beam', type=int, default=1)
+    parser.add_argument('--dropout', type=float)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--samples', type=int, default=64)
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--lengths_only', type=bool, default=False)
+    args = parser.parse_args(sys.argv[1:])
+
+    # the lengths and encoder positions only need the builder and the pretrained tokenizer, not a trained checkpoint
+    if args.lengths_only:
+        builder, tokenizer, model = load_test_builder(args.builder), load_tokenizer(args.model), None
+    else:
+        cores_dir_inference.CUDA_DEVICE = torch.device(args.device)
+        builder, tokenizer, model = load_pickles(args.model, args.builder, args.beam, f'{args.dropout}')
+        model.eval()
+        model.config.no_repeat_ngram_size = None
+
+    mention_prompts, cluster_prompts = builder_prompts(builder)
+    for name, prompts in (('mentions', mention_prompts), ('clusters', cluster_prompts)):
+        lengths = [min(len(tokenizer.encode(prompt)), 128) for prompt in prompts]
+        print_lengths(name, lengths)
+        print_positions(name, lengths, args.batch_size)
+    if model is None:
+        return
+
+    # the same sample of prompts, in batches of similar length, padded both ways
+    random.seed(0)
+    for name, prompts in (('mentions', mention_prompts), ('clusters', cluster_prompts)):
+        sample = random.sample(prompts, min(args.samples, len(prompts)))
+        sample.sort(key=lambda prompt : len(tokenizer.encode(prompt)))
+        max_length_time, max_length_outputs = time_generation(sample, model, tokenizer, args.beam, args.batch_size, 'max_length')
+        longest_time, longest_outputs = time_generation(sample, model, tokenizer, args.beam, args.batch_size, 'longest')
+        same = sum(a == b for a, b in zip(max_length_outputs, longest_outputs))
+        print(f'{name}: {len(sample)} prompts, padded to 128 {max_length_time:.2f}s, to longest {longest_time:.2f}s ' \
+              f'(x{max_length_time / longest_time:.2f}), same outputs {same} / {len(sample)}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import contextlib
+
+import torch
+
+import cores_dir_inference
+from cores_dir_inference import load_pickles, doc_key_paragraphs, InferenceScheduler
+
+# Infers the documents into mode_dir, every cluster example prompted or with skip_clustered, and returns the
+# scheduler (with its prompts and model calls counts) and the seconds it took. The inference prints go to a log.
+def run_mode(builder, tokenizer, model, args, doc_keys, mode_dir, skip_clustered, spot_check):
+    shutil.rmtree(mode_dir, ignore_errors=True)
+    os.makedirs(mode_dir)
+
+    def paragraphs():
+        for doc_key in doc_keys:
+            doc_key_dir = os.path.join(mode_dir, doc_key.replace('/', '#'))
+            os.makedirs(doc_key_dir)
+            yield from doc_key_paragraphs(doc_key_dir, doc_key, builder, tag_only_clusters=args.tag_only_clusters,
+                                          skip_clustered=skip_clustered, spot_check=spot_check)
+
+    scheduler = InferenceScheduler(model, tokenizer, args.beam, batch_size=args.batch_size, window=args.window,
+                                   score_tags=args.score_tags, copy_mentions=args.copy_mentions)
+    start = time.time()
+    with open(f'{mode_dir}.log', 'w') as log, contextlib.redirect_stdout(log), torch.no_grad():
+        scheduler.run(paragraphs())
+    return scheduler, time.time() - start
+
+def evaluate(builder, mode_dir):
+    eval_dir = f'{mode_dir}_eval'
+    shutil.rmtree(eval_dir, ignore_errors=True)
+    os.makedirs(eval_dir)
+    with open(os.path.join(eval_dir, 'eval.log'), 'w') as log, contextlib.redirect_stdout(log):
+        results = builder.paragraphs_evaluate(mode_dir, eval_dir, official=False)
+    return dict(results)
+
+def main():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('--model', type=str)
+    parser.add_argument('--builder', type=str)
+    parser.add_argument('--beam', type=int, default=1)
+    parser.add_argument('--dropout', type=float)
+    parser.add_argument('--documents', type=int, default=0)
+    parser.add_argument('--spot_checks', type=float, nargs='+', default=[0.0, 0.1, 0.25])
+    parser.add_argument('--tag_only_clusters', type=bool, default=False)
+    parser.add_argument('--score_tags', type=bool, default=False)
+    parser.add_argument('--copy_mentions', type=bool, default=False)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--window', type=int, default=64)
+    parser.add_argument('--report_dir', type=str, default='skip_report')
+    parser.add_argument('--device', type=str, default='cuda')
+    args = parser.parse_args(sys.argv[1:])
+
+    cores_dir_inference.CUDA_DEVICE = torch.device(args.device)
+    builder, tokenizer, model = load_pickles(args.model, args.builder, args.beam, f'{args.dropout}')
+    model.eval()
+    doc_keys = list(builder.doc_keys)
+    if args.documents:
+        doc_keys = doc_keys[:args.documents]
+    report_dir = os.path.join(args.report_dir, args.model, f'{args.dropout}', f'beam_{args.beam}')
+
+    modes = [('all', False, 0.0)] + [(f'skip_clustered_{spot_check}', True, spot_check) for spot_check in args.spot_checks]
+    rows = []
+    for name, skip_clustered, spot_check in modes:
+        mode_dir = os.path.join(report_dir, name)
+        scheduler, seconds = run_mode(builder, tokenizer, model, args, doc_keys, mode_dir, skip_clustered, spot_check)
+        results = evaluate(builder, mode_dir)
+        rows.append((name, scheduler, seconds, results))
+        print(f'{name}: {scheduler.cluster_prompts} cluster prompts, {scheduler.model_calls} model calls, {seconds:.1f}s, ' \
+              f'mention f1 {results["mention f1"]:.3f}, f1 {results["f1"]:.3f}')
+
+    print()
+    print(f'{len(doc_keys)} documents, beam {args.beam}')
+    print(f'{"mode":<24} {"mention prompts":>15} {"cluster prompts":>15} {"model calls":>11} {"seconds":>8} {"speed-up":>8} {"mention f1":>10} {"f1":>6}')
+    all_seconds = rows[0][2]
+    for name, scheduler, seconds, results in rows:
+        print(f'{name:<24} {scheduler.mention_prompts:>15} {scheduler.cluster_prompts:>15} {scheduler.model_calls:>11} {seconds:>8.1f} ' \
+              f'{all_seconds / seconds:>8.2f} {results["mention f1"]:>10.3f} {results["f1"]:>6.3f}')
+
+if __name__ == '__main__':
+    main()
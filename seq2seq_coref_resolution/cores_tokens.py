@@ -1,8 +1,14 @@
 import json
+import bisect
+import argparse
 import random
+import itertools
+import multiprocessing
 import logging
 import os
 import pickle
+import shutil
+import hashlib
 import time, threading, sys
 
 import datasets
@@ -60,73 +66,138 @@ def encode(sentence, clusters, cluster_tag=None, mention_tag=None):
     return sentence # by returning the list with the tokens inside we keep the words indexes
 
 
-def decode(sentence):
-    delete_indexes = []
-    for word_index, word in enumerate(sentence):
-        if (STARTING_TOKEN == word.strip()) and (word_index < len(sentence) - 1):
-            sentence[word_index] = ''
-            sentence[word_index + 1] = STARTING_TOKEN + ' ' + sentence[word_index + 1]
-        if (ENDING_TOKEN == word.strip()) and (word_index > 0):
-            sentence[word_index] = ''
-            sentence[word_index - 1] = sentence[word_index - 1] + ' ' + ENDING_TOKEN
-    sentence = [w for w in sentence if w]
-
-    for word_index, word in enumerate(sentence):
-        if (IN_CLUSTER_TOKEN == word.strip()) and (word_index > 0):
-            sentence[word_index] = ''
-            sentence[word_index - 1] = sentence[word_index - 1] + ' ' + IN_CLUSTER_TOKEN
-        if (NOT_IN_CLUSTER_TOKEN == word.strip()) and (word_index > 0):
-            sentence[word_index] = ''
-            sentence[word_index - 1] = sentence[word_index - 1] + ' ' + NOT_IN_CLUSTER_TOKEN
-        if (UNK_CLUSTER_TOKEN == word.strip()) and (word_index > 0):
-            sentence[word_index] = ''
-            sentence[word_index - 1] = sentence[word_index - 1] + ' ' + UNK_CLUSTER_TOKEN
-    sentence = [w for w in sentence if w]
-
-    start_tokens = [(i, STARTING_TOKEN, None) for i,w in enumerate(sentence) if STARTING_TOKEN in w]
-    end_tokens  = [(i, ENDING_TOKEN, True) for i,w in enumerate(sentence) if ENDING_TOKEN in w and IN_CLUSTER_TOKEN in w]
-    end_tokens += [(i, ENDING_TOKEN, False) for i,w in enumerate(sentence) if ENDING_TOKEN in w and NOT_IN_CLUSTER_TOKEN in w]
-    end_tokens += [(i, ENDING_TOKEN, 'UNK') for i,w in enumerate(sentence) if ENDING_TOKEN in w and UNK_CLUSTER_TOKEN in w]
-    end_tokens += [(i, ENDING_TOKEN, None) for i,w in enumerate(sentence) if ENDING_TOKEN in w \
-            and IN_CLUSTER_TOKEN not in w \
-            and NOT_IN_CLUSTER_TOKEN not in w \
-            and UNK_CLUSTER_TOKEN not in w]
-    spanning_tokens = start_tokens + end_tokens 
-    spanning_tokens.sort(key=lambda x:x[0])
-    missing_tokens = []
+# decode() looks at a word as a list of (marker, item) pairs: the item itself (marker is None for a word) and the
+# markers that were attached to it. Words are strings as in encode() / the model output split on spaces, or token
+# ids, then marker_ids maps the ids of the five markers to their tokens.
+class MarkupWords(object):
+    def __init__(self, marker_ids=None):
+        self.id_markers = None if marker_ids is None else {marker_id : marker for marker, marker_id in marker_ids.items()}
+
+    def word(self, item):
+        if self.id_markers is None:
+            return [(item.strip() if item.strip() in MARKERS else None, item)]
+        return [(self.id_markers.get(item), item)]
+
+    # the word a marker moved to when there is nothing left at its position
+    def blank(self, marker):
+        return [(marker, marker)] if self.id_markers is not None else [(None, ''), (marker, marker)]
+
+    # the marker a word consists of, None for real words
+    def only(self, word):
+        if self.id_markers is None:
+            text = self.text(word).strip()
+            return text if text in MARKERS else None
+        return word[0][0] if len(word) == 1 else None
+
+    def text(self, word):
+        return ' '.join(item for _, item in word)
+
+    # empty words are dropped once the markers moved, as the old list based decode did
+    def empty(self, word):
+        return self.id_markers is None and self.text(word) == ''
+
+    def has(self, word, marker, text=None):
+        if self.id_markers is None:
+            return marker in text
+        return any(word_marker == marker for word_marker, _ in word)
+
+    # the words without markers, a string for words and the list of ids for token ids
+    def clean(self, words, texts, markers):
+        if self.id_markers is not None:
+            return [item for word in words for marker, item in word if marker is None]
+        text = ' '.join(texts)
+        for tok in markers:
+            text = text.replace(tok, '')
+        return text
+
+MARKERS = [STARTING_TOKEN, ENDING_TOKEN, IN_CLUSTER_TOKEN, NOT_IN_CLUSTER_TOKEN, UNK_CLUSTER_TOKEN]
+END_TAGS = [(IN_CLUSTER_TOKEN, True), (NOT_IN_CLUSTER_TOKEN, False), (UNK_CLUSTER_TOKEN, 'UNK')]
+
+# A word that is only one of the forward markers moves to the next word (if there is one), a word that is only one
+# of the backward markers moves to the previous position (if there is one, whether or not it has been emptied).
+# A position is handed on as soon as the next one is done, nothing can attach to it anymore.
+def attach_markers(markup, words, forward, backward):
+    words = iter(words)
+    word = next(words, None)
+    previous = None  # None: no position yet / moved away
+    has_previous = False
+    carry = []
+    while word is not None:
+        following = next(words, None)
+        word = carry + word
+        carry = []
+        marker = markup.only(word)
+        if marker in forward and following is not None:
+            carry = [(marker, marker)]
+            word = None
+        elif marker in backward and has_previous:
+            previous = markup.blank(marker) if previous is None else previous + [(marker, marker)]
+            word = None
+        if previous is not None and not markup.empty(previous):
+            yield previous
+        previous, has_previous = word, True
+        word = following
+    if previous is not None and not markup.empty(previous):
+        yield previous
+
+# Mentions of a marked up sentence in one pass. << opens a mention on its word and the first end marker (>> with its
+# tag) right after it closes it, every other marker is missing. Returns the mentions ((start, end), tag) with tag
+# True ([[t]]), False ([[f]]), 'UNK' ([[u]]) or None, their text, the missing markers (index, marker, tag) with
+# their words, the mentions by tag, and the sentence without the markers ([[u]] is kept there).
+def decode(sentence, marker_ids=None):
+    markup = MarkupWords(marker_ids)
+    words = (markup.word(item) for item in sentence)
+    words = attach_markers(markup, words, forward=[STARTING_TOKEN], backward=[ENDING_TOKEN])
+    words = attach_markers(markup, words, forward=[], backward=[IN_CLUSTER_TOKEN, NOT_IN_CLUSTER_TOKEN, UNK_CLUSTER_TOKEN])
+
+    decoded_words = []
+    texts = []
     mentions = []
-
-    i = 0
-    while i  < len(spanning_tokens):
-        tok_i, tok, tok_c_tag = spanning_tokens[i]
-
-        if STARTING_TOKEN == tok and i < len(spanning_tokens) - 1:
-            next_tok_i, next_tok, next_tok_c_tag = spanning_tokens[i + 1]
-            if ENDING_TOKEN == next_tok:
-                mentions.append(((tok_i, next_tok_i), next_tok_c_tag))
-                i += 2
+    missing_tokens = []
+    opened = None
+    for word_index, word in enumerate(words):
+        text = markup.text(word) if markup.id_markers is None else None
+        decoded_words.append(word)
+        texts.append(text)
+        spanning_tokens = []
+        if markup.has(word, STARTING_TOKEN, text):
+            spanning_tokens.append((word_index, STARTING_TOKEN, None))
+        if markup.has(word, ENDING_TOKEN, text):
+            tags = [c_tag for tag, c_tag in END_TAGS if markup.has(word, tag, text)]
+            spanning_tokens += [(word_index, ENDING_TOKEN, c_tag) for c_tag in tags or [None]]
+        for token in spanning_tokens:
+            if opened is not None and token[1] == ENDING_TOKEN:
+                mentions.append(((opened[0], token[0]), token[2]))
+                opened = None
                 continue
-
-        missing_tokens.append(spanning_tokens[i])
-        i += 1
-
-    textual_missing_tokens = [ sentence[i] for i, _, _ in missing_tokens]
+            if opened is not None:
+                missing_tokens.append(opened)
+                opened = None
+            if token[1] == STARTING_TOKEN:
+                opened = token
+            else:
+                missing_tokens.append(token)
+    if opened is not None:
+        missing_tokens.append(opened)
+
+    def textual(start, end):
+        return markup.clean(decoded_words[start : end + 1], texts[start : end + 1], MARKERS)
+    textual_missing_tokens = [textual(i, i) if markup.id_markers is not None else texts[i] for i, _, _ in missing_tokens]
     clusters = { True : [], False : [], 'UNK': [], None: []}
     textual_clusters = { True : [], False : [], 'UNK': [],  None : []}
     textual_mentions = []
     for m, c_tag in mentions:
-        textual_mention = ' '.join(sentence[m[0] : m[1] + 1])
-        for tok in [STARTING_TOKEN, ENDING_TOKEN, IN_CLUSTER_TOKEN, NOT_IN_CLUSTER_TOKEN, UNK_CLUSTER_TOKEN]:
-            textual_mention = textual_mention.replace(tok, '')
-        textual_mention = "".join(textual_mention.rstrip().lstrip())
+        textual_mention = textual(m[0], m[1])
+        if markup.id_markers is None:
+            textual_mention = textual_mention.strip()
         clusters[c_tag].append(m) 
         textual_mentions.append(textual_mention) 
         textual_clusters[c_tag].append(textual_mention) 
 
-    for index, _ in enumerate(sentence):
-        for tok in [STARTING_TOKEN, ENDING_TOKEN, IN_CLUSTER_TOKEN, NOT_IN_CLUSTER_TOKEN]:
-            sentence[index] = sentence[index].replace(tok, '')
-    sentence = ' '.join(sentence)
+    if markup.id_markers is None:
+        sentence = ' '.join(markup.clean([word], [text], MARKERS[:4]) for word, text in zip(decoded_words, texts))
+    else:
+        sentence = markup.clean(decoded_words, texts, MARKERS)
     decode_results = { 
                        'sentence' : sentence, 
                        'mentions' : mentions, 
@@ -150,166 +221,574 @@ def str_clusters(sentence, clusters):
     sentence_clusters = [ p for c in sentence_clusters for p in c ]
     return sentence_clusters
 
+# Keeps only the mentions that are fully inside words[start:end], re-based to the chunk.
+def chunk_words(words, clusters, start, end):
+    new_clusters = [ [[s - start, e - start] for s, e in cluster if s >= start and e < end] for cluster in clusters ]
+    new_clusters = [ cluster for cluster in new_clusters if cluster ]
+    return words[start:end], new_clusters
+
+# The exact check. The MarkupEncoder lengths (the ids the builder stores, from per-word pieces) reject most chunks
+# without the tokenizer, and a chunk they accept is also tokenized as joined strings, since the tokenizer can merge
+# pieces across word and marker boundaries and disagree with them.
+def chunk_fits(word_pieces, words, clusters, start, end, max_seq_length):
+    new_words, new_clusters = chunk_words(words, clusters, start, end)
+    encoder = MarkupEncoder(word_pieces, new_words, new_clusters)
+    if len(encoder.plain()) > max_seq_length or len(encoder) > max_seq_length:
+        return False
+    tokenizer = word_pieces.tokenizer
+    if len(tokenizer(' '.join(new_words))['input_ids']) > max_seq_length:
+        return False
+    return len(tokenizer(encoder.render())['input_ids']) <= max_seq_length
+
+class WordPieces(object):
+    # word -> sub-token ids, so every distinct word (and marker) is tokenized once per builder
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.cache = {}
+
+    # the memo is not part of the builder, pickles stay the same however the builder was built
+    def __getstate__(self):
+        return {'tokenizer' : self.tokenizer, 'cache' : {}}
+
+    def __call__(self, word, leading_space=True):
+        key = (word, leading_space)
+        if key not in self.cache:
+            text = ' ' + word if leading_space else word
+            self.cache[key] = self.tokenizer.encode(text, add_special_tokens=False)
+        return self.cache[key]
+
+    # tokenizes the words not cached yet in one batched tokenizer call, each word is still encoded on its own so the
+    # ids are the ones __call__ gives
+    def update(self, words, leading_space=True):
+        missing = list(dict.fromkeys(word for word in words if (word, leading_space) not in self.cache))
+        if not missing:
+            return
+        texts = [' ' + word if leading_space else word for word in missing]
+        for word, ids in zip(missing, self.tokenizer(texts, add_special_tokens=False)['input_ids']):
+            self.cache[(word, leading_space)] = ids
+
+# The words of a document MarkupEncoder tokenizes without their leading space: the words a chunk can start at
+# (starts), the first word of every mention and the word after every mention.
+def unspaced_words(words, clusters, starts=(0,)):
+    indexes = set(starts)
+    for cluster in clusters:
+        for start, end in cluster:
+            indexes.update((start, end + 1))
+    return [words[i] for i in sorted(indexes) if i < len(words)]
+
+# Where encode() puts its markers in a paragraph: a << before every word a mention starts at, and after every word a
+# mention ends at a >> and a tag slot. A slot belongs to the first mention (in clusters order) ending at its word and
+# only the tags depend on the variant, so the text between the slots is joined once and every variant (mentions
+# target, cluster targets, mention inputs) is the fixed segments with one tag per slot.
+class MarkupLayout(object):
+    def __init__(self, words, clusters):
+        starts = set(mention[0] for cluster in clusters for mention in cluster)
+        slots = {}
+        for cluster_index, cluster in enumerate(clusters):
+            for mention in cluster:
+                slots.setdefault(mention[1], (cluster_index, mention))
+        self.ends = sorted(slots)
+        self.owners = [slots[end] for end in self.ends]
+        self.words = words
+        self.starts = starts
+
+        # segments[k] ends with the >> of ends[k], tail is what comes after the last slot
+        self.segments = []
+        current = []
+        for word_index, word in enumerate(words):
+            current.append(STARTING_TOKEN + ' ' + word if word_index in starts else word)
+            if word_index in slots:
+                current.append(ENDING_TOKEN)
+                self.segments.append(' '.join(current))
+                current = []
+        self.tail = ' '.join(current)
+
+    # tag of every slot, same rules as encode()
+    def tags(self, cluster_tag=None, mention_tag=None):
+        if cluster_tag is None:
+            return [UNK_CLUSTER_TOKEN] * len(self.owners)
+        if mention_tag is None:
+            return [IN_CLUSTER_TOKEN if cluster_index == cluster_tag else NOT_IN_CLUSTER_TOKEN for cluster_index, _ in self.owners]
+        return [IN_CLUSTER_TOKEN if cluster_index == cluster_tag and mention == mention_tag else UNK_CLUSTER_TOKEN
+                for cluster_index, mention in self.owners]
+
+    # ' '.join(encode(words, clusters, cluster_tag, mention_tag))
+    def render(self, cluster_tag=None, mention_tag=None):
+        parts = []
+        for segment, tag in zip(self.segments, self.tags(cluster_tag, mention_tag)):
+            parts.append(segment)
+            parts.append(tag)
+        if self.tail:
+            parts.append(self.tail)
+        return ' '.join(parts)
+
+class MarkupEncoder(object):
+    # MarkupLayout on sub-token ids: the paragraph words come from word_pieces and the five added marker ids are
+    # spliced in, so no variant goes through the tokenizer. Like the tokenizer does on the joined string, a word at
+    # the beginning of the text or right after a marker is tokenized without its leading space (added tokens strip
+    # the whitespace around them). Every marker is a single id, so all the variants have the same length.
+    def __init__(self, word_pieces, words, clusters=()):
+        self.word_pieces = word_pieces
+        self.layout = MarkupLayout(words, clusters)
+        self.marker_ids = {marker: word_pieces.tokenizer.convert_tokens_to_ids(marker) for marker in get_cores_tokens()}
+
+        ends = set(self.layout.ends)
+        self.segments = []
+        current = []
+        after_marker = True
+        for word_index, word in enumerate(words):
+            if word_index in self.layout.starts:
+                current.append(self.marker_ids[STARTING_TOKEN])
+                after_marker = True
+            current.extend(word_pieces(word, leading_space=not after_marker))
+            after_marker = False
+            if word_index in ends:
+                current.append(self.marker_ids[ENDING_TOKEN])
+                self.segments.append(current)
+                current = []
+                after_marker = True
+        self.tail = current
+        self.length = sum(len(segment) + 1 for segment in self.segments) + len(self.tail) + \
+                      word_pieces.tokenizer.num_special_tokens_to_add()
+
+    # the words without markup (the model input of the mentions stage)
+    def plain(self):
+        ids = []
+        for word_index, word in enumerate(self.layout.words):
+            ids.extend(self.word_pieces(word, leading_space=word_index > 0))
+        return self.word_pieces.tokenizer.build_inputs_with_special_tokens(ids)
+
+    def encode(self, cluster_tag=None, mention_tag=None):
+        ids = []
+        for segment, tag in zip(self.segments, self.layout.tags(cluster_tag, mention_tag)):
+            ids.extend(segment)
+            ids.append(self.marker_ids[tag])
+        ids.extend(self.tail)
+        return self.word_pieces.tokenizer.build_inputs_with_special_tokens(ids)
+
+    def render(self, cluster_tag=None, mention_tag=None):
+        return self.layout.render(cluster_tag, mention_tag)
+
+    def __len__(self):
+        return self.length
+
+class TokenLengthIndex(object):
+    # Cumulative sub-token counts of a document's words (the model input) and of their encode() markup
+    # (the mentions target), so a chunk boundary is a binary search instead of re-tokenizing shrinking chunks.
+    # The counts are estimates (words are tokenized one by one), pick_chunk_end() settles the exact boundary.
+    def __init__(self, words, clusters, word_pieces):
+        self.input_prefix = [0]
+        for word in words:
+            self.input_prefix.append(self.input_prefix[-1] + len(word_pieces(word)))
+        self.start_marker_length = len(word_pieces(STARTING_TOKEN, leading_space=False))
+        self.end_marker_length   = len(word_pieces(ENDING_TOKEN, leading_space=False)) + \
+                                   max(len(word_pieces(tok, leading_space=False)) for tok in (UNK_CLUSTER_TOKEN, IN_CLUSTER_TOKEN, NOT_IN_CLUSTER_TOKEN))
+        self.mentions = sorted(set((start, end) for cluster in clusters for start, end in cluster))
+        self.mention_starts = [start for start, _ in self.mentions]
+
+    def __len__(self):
+        return len(self.input_prefix) - 1
+
+    # target_prefix[k] is the target length of words[start:start + k]. Only mentions inside [start, stop) are marked,
+    # encode() puts a single << on a word however many mentions start there (and a single >> tag on an end word),
+    # and a << shows up once the first mention starting at that word is closed.
+    def target_prefix(self, start, stop):
+        markers = [0] * (stop - start)
+        first_end = {}
+        ends = set()
+        for s, e in self.mentions[bisect.bisect_left(self.mention_starts, start) : bisect.bisect_left(self.mention_starts, stop)]:
+            if e < s or e >= stop:
+                continue
+            ends.add(e)
+            first_end[s] = min(first_end.get(s, e), e)
+        for e in ends:
+            markers[e - start] += self.end_marker_length
+        for e in first_end.values():
+            markers[e - start] += self.start_marker_length
+
+        prefix = [0]
+        for k in range(stop - start):
+            prefix.append(prefix[-1] + self.input_prefix[start + k + 1] - self.input_prefix[start + k] + markers[k])
+        return prefix
+
+    # Largest end (out of boundaries, every word when None) such that words[start:end] and its markup fit the budget.
+    def max_end(self, start, budget, boundaries=None):
+        stop = bisect.bisect_right(self.input_prefix, self.input_prefix[start] + budget) - 1
+        target = self.target_prefix(start, stop)
+        end = start + bisect.bisect_right(target, budget) - 1
+        if boundaries is not None:
+            i = bisect.bisect_right(boundaries, end) - 1
+            end = boundaries[i] if i >= 0 else start
+        return end
+
+# Estimated boundary from the index, then nudged with the exact tokenizer check (fits(end) -> bool) so the chunk is the
+# largest one that really fits. Typically two tokenizer calls per chunk instead of one per shrinking step.
+# A chunk always takes at least one boundary step so the caller makes progress.
+def pick_chunk_end(index, start, budget, boundaries, fits):
+    if boundaries is None:
+        boundaries = range(start + 1, len(index) + 1)
+    else:
+        boundaries = boundaries[bisect.bisect_right(boundaries, start):]
+    if not boundaries:
+        return len(index)
+
+    end = index.max_end(start, budget, boundaries)
+    i = bisect.bisect_left(boundaries, end) if end > start else 0
+    if i == 0 or fits(boundaries[i]):
+        while i < len(boundaries) - 1 and fits(boundaries[i + 1]):
+            i += 1
+    else:
+        i -= 1
+        while i > 0 and not fits(boundaries[i]):
+            i -= 1
+    return boundaries[i]
+
+# Greedy packing on the estimates alone: (start, end) chunks, None if some single step does not fit the budget.
+def pack_chunks(index, boundaries, budget):
+    chunks = []
+    start = 0
+    while start < len(index):
+        end = index.max_end(start, budget, boundaries)
+        if end <= start:
+            return None
+        chunks.append((start, end))
+        start = end
+    return chunks
+
+# Same number of chunks as greedy packing, but with the smallest budget that still allows it,
+# so the chunks come out of similar length instead of full chunks followed by a short tail.
+def balanced_chunks(index, boundaries, budget, count):
+    lo, hi = 1, budget
+    while lo < hi:
+        mid = (lo + hi) // 2
+        chunks = pack_chunks(index, boundaries, mid)
+        if chunks is not None and len(chunks) <= count:
+            hi = mid
+        else:
+            lo = mid + 1
+    return pack_chunks(index, boundaries, lo)
+
+_worker_builder = None
+def _init_worker(builder):
+    global _worker_builder
+    _worker_builder = builder
+
+def _process_document_worker(item):
+    idx, document = item
+    return _worker_builder._process_document(idx, document)
+
+# builder._process_document(idx, document) for every document, on a pool of worker processes when workers > 1.
+# Results are returned in the documents order whatever the number of workers, so builders are reproducible.
+# The serial results go through pickle as well, otherwise they share words with the parsed documents
+# and the pickled builder is not byte for byte the same as the one built by the pool.
+# With a DocumentCache only the documents that are not in the cache are processed, the cached results get the idx of
+# the document in this file.
+def process_documents(builder, documents, workers=1, start=0, cache=None):
+    items = list(enumerate(documents, start))
+    results = {} if cache is None else {idx : builder._reindex(result, idx) for idx, result in cache.load(items).items()}
+    pending = [item for item in items if item[0] not in results]
+    if cache is not None:
+        print(f"Reusing {len(results)} / {len(items)} documents from {cache.cache_dir}")
+    if workers <= 1 or len(pending) <= 1:
+        pending_results = [pickle.loads(pickle.dumps(builder._process_document(idx, document))) for idx, document in pending]
+    else:
+        print(f"Processing {len(pending)} documents with {workers} workers")
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(builder,)) as pool:
+            pending_results = pool.map(_process_document_worker, pending, chunksize=max(1, len(pending) // (workers * 8)))
+    for (idx, document), result in zip(pending, pending_results):
+        results[idx] = result
+        if cache is not None:
+            cache.save(idx, document, result)
+    return [results[idx] for idx, _ in items]
+
+# the json objects of a jsonlines file one at a time, after skipping the first skip lines
+def iter_jsonlines(path, skip=0):
+    with open(path, 'r') as f:
+        for line in itertools.islice(f, skip, None):
+            yield json.loads(line.strip())
+
+# number of mentions, largest cluster and number of clusters of a document
+def cluster_stats(clusters):
+    return len(flatten_list_of_lists(clusters)), max(len(cluster) for cluster in clusters) if clusters else 0, len(clusters) if clusters else 0
+
+# write to path.tmp and rename, a preempted job never leaves a truncated file behind
+def atomic_dump(obj, path, dump=pickle.dump, mode='wb'):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, mode) as f:
+        dump(obj, f)
+    os.replace(tmp_path, path)
+
+# shards_dir/shard_{i}.pkl hold the (document, result) pairs of consecutive documents and shards_dir/manifest.json
+# the shards that are done. A manifest written for another configuration (input file, tokenizer, max_seq_length...)
+# is not resumed, the shards are built again.
+class DocumentShards(object):
+    def __init__(self, shards_dir, config):
+        self.shards_dir = shards_dir
+        self.manifest_path = os.path.join(shards_dir, 'manifest.json')
+        self.manifest = {'config' : config, 'num_documents' : 0, 'shards' : [], 'complete' : False}
+        os.makedirs(shards_dir, exist_ok=True)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+            if manifest['config'] == config:
+                self.manifest = manifest
+                print(f"Resuming {shards_dir}: shards = {len(manifest['shards'])} documents = {manifest['num_documents']}")
+            else:
+                print(f"Configuration changed, rebuilding {shards_dir}")
+
+    @property
+    def num_documents(self):
+        return self.manifest['num_documents']
+
+    @property
+    def complete(self):
+        return self.manifest['complete']
+
+    def write(self, pairs):
+        shard_file = f"shard_{len(self.manifest['shards']):05d}.pkl"
+        atomic_dump(pairs, os.path.join(self.shards_dir, shard_file))
+        self.manifest['shards'].append({'file' : shard_file, 'first_document' : self.num_documents, 'num_documents' : len(pairs)})
+        self.manifest['num_documents'] += len(pairs)
+        atomic_dump(self.manifest, self.manifest_path, json.dump, 'w')
+        print(f"Saved {shard_file}: documents = {self.num_documents}")
+
+    def finish(self):
+        self.manifest['complete'] = True
+        atomic_dump(self.manifest, self.manifest_path, json.dump, 'w')
+
+    def __iter__(self):
+        for shard in self.manifest['shards']:
+            with open(os.path.join(self.shards_dir, shard['file']), 'rb') as f:
+                pairs = pickle.load(f)
+            yield from pairs
+
+# Bump whenever a change to the builders changes what they produce, cached builders and documents of
+# another version are not reused.
+PREPROCESSOR_VERSION = 5
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def json_md5(obj):
+    return hashlib.md5(json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()
+
+# Everything but the input file that decides the output of a builder: the vocabulary includes the added cores tokens.
+def builder_config(builder_class, tokenizer, max_seq_length, packing=None):
+    return {'builder' : builder_class.__name__, 'version' : PREPROCESSOR_VERSION,
+            'tokenizer' : type(tokenizer).__name__, 'vocab' : json_md5(tokenizer.get_vocab()),
+            'max_seq_length' : max_seq_length, 'packing' : packing}
+
+# Results of single documents, cache_dir/{md5 of document}.pkl. cache_dir is per builder_config, so a document keeps
+# its result as long as it does not change, wherever it moves in the file. The results keep the idx they were built
+# with, builder._reindex gives them the current one.
+class DocumentCache(object):
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, document):
+        return os.path.join(self.cache_dir, f'{json_md5(document)}.pkl')
+
+    def load(self, items):
+        results = {}
+        for idx, document in items:
+            path = self._path(document)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    results[idx] = pickle.load(f)
+        return results
+
+    def save(self, idx, document, result):
+        atomic_dump(result, self._path(document))
+
+# builders_dir/cache/{name}.{key}{ext} holds the builders, key is the md5 of the builder_config and of the input file,
+# and builders_dir/{name}{ext} links to the last one that was built or loaded, so the scripts that read builders keep
+# their paths. Documents that did not change are reused from builders_dir/documents/{md5 of builder_config}.
+class BuilderCache(object):
+    def __init__(self, builders_dir, name, config, data_path, ext=''):
+        self.link_path = os.path.join(builders_dir, f'{name}{ext}')
+        self.path = os.path.join(builders_dir, 'cache', f'{name}.{json_md5(dict(config, data=file_md5(data_path)))}{ext}')
+        self.documents_dir = os.path.join(builders_dir, 'documents', json_md5(config))
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def link(self):
+        if os.path.lexists(self.link_path) and not os.path.islink(self.link_path):
+            backup_path = f'{self.link_path}.bak'
+            if os.path.lexists(backup_path):
+                raise FileExistsError(f"{self.link_path} is not a link to the cache and {backup_path} already exists, move one of them away")
+            print(f"Moving builder that is not in the cache to {backup_path}")
+            os.rename(self.link_path, backup_path)
+        tmp_link = f'{self.link_path}.tmp'
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.relpath(self.path, os.path.dirname(self.link_path)), tmp_link)
+        os.replace(tmp_link, self.link_path)
+        print(f"{self.link_path} -> {self.path}")
+
+# (document, builder._process_document(...)) for every document of data_path, in the file order, as an iterable that
+# can be read more than once. Without shards_dir everything is done in memory. With shards_dir the documents are read
+# lazily and processed shard_size at a time, every shard is saved as soon as it is done, and a restarted job continues
+# after the last saved shard. The pairs are then read back from the shards one shard at a time.
+def build_documents(builder, data_path, workers=1, shards_dir=None, shard_size=256, documents_dir=None):
+    cache = None if documents_dir is None else DocumentCache(documents_dir)
+    if shards_dir is None:
+        documents = list(builder._read_jsonlines(data_path))
+        return list(zip(documents, process_documents(builder, documents, workers, cache=cache)))
+
+    config = builder_config(type(builder), builder.tokenizer, builder.max_seq_length, getattr(builder, 'packing', None))
+    config.update({'data' : file_md5(data_path), 'shard_size' : shard_size})
+    shards = DocumentShards(shards_dir, config)
+    if not shards.complete:
+        documents = builder._read_jsonlines(data_path, skip=shards.num_documents)
+        while True:
+            batch = list(itertools.islice(documents, shard_size))
+            if not batch:
+                break
+            results = process_documents(builder, batch, workers, start=shards.num_documents, cache=cache)
+            shards.write(list(zip(batch, results)))
+        shards.finish()
+    return shards
+
+MENTION_FEATURES = datasets.Features({'idx' : datasets.Value('string'), 'input_str' : datasets.Value('string'),
+                                      'output_str' : datasets.Value('string'),
+                                      'input_ids' : datasets.Sequence(datasets.Value('int64')),
+                                      'labels' : datasets.Sequence(datasets.Value('int64')),
+                                      'clusters' : datasets.Sequence(datasets.Sequence(datasets.Sequence(datasets.Value('int64'))))})
+CLUSTER_FEATURES = datasets.Features({'idx' : datasets.Value('string'), 'paragraph' : datasets.Value('int64'),
+                                      'cluster_index' : datasets.Value('int64'),
+                                      'mention' : datasets.Sequence(datasets.Value('int64'))})
+
+# mentions_df rows of the (document, result) pairs of build_documents, read one document at a time
+def mention_rows(pairs):
+    for _, (mention_examples, _, _, _) in pairs:
+        for example in mention_examples:
+            yield dict(zip(MENTION_FEATURES, example))
+
+# clusters_df rows, paragraph is the mentions_df row of the example paragraph (its index in the document plus the
+# paragraphs of the documents before it)
+def cluster_rows(pairs):
+    paragraphs = 0
+    for _, (mention_examples, _, cluster_examples, _) in pairs:
+        for idx, paragraph, cluster_index, mention in cluster_examples:
+            yield {'idx' : idx, 'paragraph' : paragraphs + paragraph, 'cluster_index' : cluster_index, 'mention' : mention}
+        paragraphs += len(mention_examples)
+
 class CoresDatasetPreProcessor(object):
-    def __init__(self, training_data_path, tokenizer, max_seq_length=-1, batch_size=1, val_size=0.2, is_test=False):
-        self.mention_examples = []
-        self.cluster_examples = []
+    def __init__(self, training_data_path, tokenizer, max_seq_length=-1, batch_size=1, val_size=0.2, is_test=False, workers=1,
+                 shards_dir=None, shard_size=256, documents_dir=None, tables_cache_dir=None):
         self.batch_size = batch_size
         self.val_size = val_size
         self.max_seq_length = max_seq_length
 
         self.tokenizer = tokenizer
+        self.word_pieces = WordPieces(tokenizer)
         print(f"Reading dataset from {training_data_path}")
-        examples, self.max_mention_num, self.max_cluster_size, self.max_num_clusters = self._parse_jsonlines(training_data_path)
-        self.num_mention_examples_filtered, trunced_examples = self._entity_mention_tokenize(examples)
+        self.max_mention_num = -1
+        self.max_cluster_size = -1
+        self.max_num_clusters = -1
+        self.num_mention_examples_filtered = 0
+        self.num_cluster_examples_filtered = 0
+        trunced_examples = []
+        pairs = build_documents(self, training_data_path, workers, shards_dir, shard_size, documents_dir)
+        for (_, _, clusters, _), (_, doc_trunced_examples, _, num_filtered) in pairs:
+            mention_num, cluster_size, num_clusters = cluster_stats(clusters)
+            self.max_mention_num = max(self.max_mention_num, mention_num)
+            self.max_cluster_size = max(self.max_cluster_size, cluster_size)
+            self.max_num_clusters = max(self.max_num_clusters, num_clusters)
+            if is_test:
+                trunced_examples.extend(doc_trunced_examples)
+            self.num_cluster_examples_filtered += num_filtered
         if is_test:
             self.env_examples = self._mentions_with_envs(trunced_examples)
 
-        self.num_cluster_examples_filtered = self._binary_clustering_tokenize(trunced_examples)
-        self.mentions_df = pd.DataFrame(self.mention_examples, columns=['idx', 'input_str', 'output_str'])
-        self.clusters_df = pd.DataFrame(self.cluster_examples, columns=['idx', 'cluster_index', 'mention', 'input_str', 'output_str'])
+        # the tables are written to Arrow files in tables_cache_dir as the pairs are read, one shard at a time
+        # with shards_dir, so the examples of the whole corpus are never in memory together
+        self.mentions_df = Dataset.from_generator(mention_rows, features=MENTION_FEATURES, gen_kwargs={'pairs' : pairs}, cache_dir=tables_cache_dir)
+        self.clusters_df = Dataset.from_generator(cluster_rows, features=CLUSTER_FEATURES, gen_kwargs={'pairs' : pairs}, cache_dir=tables_cache_dir)
         print(f"Mentions: {len(self.mentions_df)}")
         print(f"Clusters: {len(self.clusters_df)}")
             
-    def _parse_jsonlines(self, training_data_path):
-        examples = []
-        max_mention_num = -1
-        max_cluster_size = -1
-        max_num_clusters = -1
-        with open(training_data_path, 'r') as f:
-            for line in f:
-                d = json.loads(line.strip())
-                doc_key = d["doc_key"]
-                input_words = flatten_list_of_lists(d["sentences"])
-                clusters = d["clusters"]
-                max_mention_num = max(max_mention_num, len(flatten_list_of_lists(clusters)))
-                max_cluster_size = max(max_cluster_size, max(len(cluster) for cluster in clusters) if clusters else 0)
-                max_num_clusters = max(max_num_clusters, len(clusters) if clusters else 0)
-                speakers = flatten_list_of_lists(d["speakers"])
-                examples.append((doc_key, input_words, clusters, speakers))
-        return examples, max_mention_num, max_cluster_size, max_num_clusters
-
-    def _trunc_words(self, words, clusters, trunc_count):
-        if trunc_count > 0:
-            w = words[:-trunc_count]
-        else:
-            w = words
-        new_clusters = [ [[start, end] for start, end in cluster if start < len(w) and end < len(w)] for cluster in clusters ]
-        new_clusters = [ cluster for cluster in new_clusters if cluster ]
-        mentions_count = sum([len(c) for c in new_clusters])
-        #print(f"trunc_count = {trunc_count}, w length = {len(w)}, mentions_count = {mentions_count}")
-        return w, new_clusters
-
-    def _process_example(self, words, clusters, trunc_step=10):
-        w = list(words)
-        trunc_count= 0
-        total_mention_count = sum([len(c) for c in clusters])
-        while w:
-            w, new_clusters  = self._trunc_words(list(words), clusters, trunc_count)
-            words_str        = ' '.join(w)
-            tokenized_input  = self.tokenizer(words_str, padding="max_length") # padding
-            input_ids        = tokenized_input['input_ids']
-            input_ids        = torch.tensor(input_ids).unsqueeze(0)
-            input_ids_mask   = tokenized_input['attention_mask']
-            input_ids_mask   = torch.tensor(input_ids_mask).unsqueeze(0)
-
-            entity_mentions = encode(w, new_clusters, None)
-            entity_mentions = ' '.join(entity_mentions)
-            tokenized_output = self.tokenizer(entity_mentions, padding="max_length")
-            output_ids       = tokenized_output['input_ids']
-            output_ids       = torch.tensor(output_ids).unsqueeze(0)
-            output_ids_mask  = tokenized_output['attention_mask']
-            output_ids_mask  = torch.tensor(output_ids_mask).unsqueeze(0)
-
-            #output_str = self.tokenizer.batch_decode(output_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
-            if 0 < self.max_seq_length < input_ids.shape[1]:
-                trunc_count += trunc_step
-                continue
-                
-            if 0 < self.max_seq_length < output_ids.shape[1]:
-                trunc_count += trunc_step
-                continue
-            break
-            print('Done')
-        return w, words_str, new_clusters, entity_mentions, trunc_count
-
-    def _entity_mention_tokenize(self, examples):
+    def _read_jsonlines(self, training_data_path, skip=0):
+        for d in iter_jsonlines(training_data_path, skip):
+            doc_key = d["doc_key"]
+            input_words = flatten_list_of_lists(d["sentences"])
+            clusters = d["clusters"]
+            speakers = flatten_list_of_lists(d["speakers"])
+            yield (doc_key, input_words, clusters, speakers)
+
+    def _chunk_end(self, index, words, clusters, start, boundaries=None):
+        if self.max_seq_length <= 0:
+            return len(words)
+        return pick_chunk_end(index, start, self.max_seq_length - self.tokenizer.num_special_tokens_to_add(), boundaries,
+                              lambda end: chunk_fits(self.word_pieces, words, clusters, start, end, self.max_seq_length))
+
+    # Everything the builder keeps for a single document, documents are independent of each other.
+    def _process_document(self, idx, example):
+        _, words, clusters, _ = example
+        # the words are tokenized in two batches before the chunking, which then only reads the memo
+        self.word_pieces.update(words)
+        self.word_pieces.update(unspaced_words(words, clusters), leading_space=False)
+        mention_examples, trunced_examples = self._entity_mention_tokenize(idx, words, clusters)
+        num_examples_filtered, cluster_examples = self._binary_clustering_tokenize(trunced_examples)
+        return mention_examples, trunced_examples, cluster_examples, num_examples_filtered
+
+    # A cached _process_document result with the idx of the document in the current file.
+    def _reindex(self, result, idx):
+        mention_examples, trunced_examples, cluster_examples, num_examples_filtered = result
+        mention_examples = [(f"{idx}_{example[0].rsplit('_', 1)[1]}",) + tuple(example[1:]) for example in mention_examples]
+        trunced_examples = [(idx,) + tuple(example[1:]) for example in trunced_examples]
+        cluster_examples = [(f"{idx}_{trunced_examples[paragraph][1]}", paragraph, c_i, mention)
+                            for _, paragraph, c_i, mention in cluster_examples]
+        return mention_examples, trunced_examples, cluster_examples, num_examples_filtered
+
+    def _entity_mention_tokenize(self, idx, words, clusters):
+        mention_examples = []
         trunced_examples = []
-        num_examples_filtered = 0
-        for idx, (_, words, clusters, _) in enumerate(examples):
-            chunk_id = 0
-            try:
-                new_words, words_str, new_clusters, entity_mentions, trunc_count = self._process_example(words, clusters)
-            except:
-                continue
-            self.mention_examples.append((f"{idx}_{chunk_id}", words_str, entity_mentions))
-            trunced_examples.append((idx, chunk_id, new_words, new_clusters))
-            print(f"mention: idx = {idx} chunk_id = {chunk_id}")
-
-            trunc_length = len(new_words)
-            while trunc_length <  len(words):
-                remain_words    = words[trunc_length:]
-                remain_clusters = [ [[start - trunc_length , end - trunc_length] for start, end in cluster \
-                                  if start >= trunc_length and end >= trunc_length] for cluster in clusters ]
-                remain_clusters = [ cluster for cluster in remain_clusters if cluster ]
-                new_words, words_str, new_clusters, entity_mentions, trunc_count = self._process_example(remain_words, remain_clusters)
-                chunk_id += 1
-                if new_clusters:
-                    self.mention_examples.append((f"{idx}_{chunk_id}", words_str, entity_mentions))
-                    trunced_examples.append((idx, chunk_id, new_words, new_clusters))
-                    print(f"mention: idx = {idx} chunk_id = {chunk_id}")
-                else:
-                    print(f"IGNORED! mention: idx = {idx} chunk_id = {chunk_id}")
-                trunc_length += len(new_words)
-                if new_words == remain_words:
-                    break
-
-        return num_examples_filtered, trunced_examples
+        index = TokenLengthIndex(words, clusters, self.word_pieces)
+        chunk_id = 0
+        start = 0
+        while start < len(words):
+            end = self._chunk_end(index, words, clusters, start)
+            new_words, new_clusters = chunk_words(words, clusters, start, end)
+            if chunk_id == 0 or new_clusters:
+                words_str       = ' '.join(new_words)
+                encoder         = MarkupEncoder(self.word_pieces, new_words, new_clusters)
+                entity_mentions = encoder.render()
+                mention_examples.append((f"{idx}_{chunk_id}", words_str, entity_mentions, encoder.plain(), encoder.encode(), new_clusters))
+                trunced_examples.append((idx, chunk_id, new_words, new_clusters))
+                print(f"mention: idx = {idx} chunk_id = {chunk_id} words = {start}:{end}/{len(words)}")
+            else:
+                print(f"IGNORED! mention: idx = {idx} chunk_id = {chunk_id} words = {start}:{end}/{len(words)}")
+            chunk_id += 1
+            start = end
+
+        return mention_examples, trunced_examples
 
     def _binary_clustering_tokenize(self, examples):
-        coref_examples = []
+        cluster_examples = []
         num_examples_filtered = 0
-        for (idx, chunk_id, words, clusters) in examples:
+        # examples are kept as (idx, paragraph, cluster_index, mention), paragraph is the index of the chunk in
+        # examples (its mentions_df row), see cluster_example for the input / target
+        for paragraph, (idx, chunk_id, words, clusters) in enumerate(examples):
             current_cluster_examples = []
             mentions = sum([len(c) for c in clusters])
-            for c_i, cluster in enumerate(clusters):
-                try:
-                    cluster_output_str = encode(words, clusters, cluster_tag=c_i, mention_tag=None)
-                    cluster_output_str = ' '.join(cluster_output_str)
-                    cluster_output   = self.tokenizer(cluster_output_str, padding="max_length")
-                    output_ids       = cluster_output['input_ids']
-                    output_ids       = torch.tensor(output_ids).unsqueeze(0)
-                    output_ids_mask  = cluster_output['attention_mask']
-                    output_ids_mask  = torch.tensor(output_ids_mask).unsqueeze(0)
-                except:
-                    num_examples_filtered += len(cluster)
-                    continue
-                    
-                if 0 < self.max_seq_length < output_ids.shape[1]:
-                    num_examples_filtered += len(cluster)
-                    continue
-
-                for mention in cluster:
-                    try:
-                        mention_input_str   = encode(words, clusters, cluster_tag=c_i, mention_tag=mention)
-                        mention_input_str   = ' '.join(mention_input_str)
-                        mention_input   = self.tokenizer(mention_input_str, padding="max_length")
-                        input_ids       = mention_input['input_ids']
-                        input_ids       = torch.tensor(input_ids).unsqueeze(0)
-                        input_ids_mask  = mention_input['attention_mask']
-                        input_ids_mask  = torch.tensor(input_ids_mask).unsqueeze(0)
-                    except Exception as e:
-                        num_examples_filtered += 1
-                        continue
-
-                    if 0 < self.max_seq_length < input_ids.shape[1]:
-                        num_examples_filtered += 1
-                        continue
-
-                    current_cluster_examples.append((f"{idx}_{chunk_id}", c_i, mention, mention_input_str, cluster_output_str))
+            # every cluster target and mention input of the paragraph has the length of its markup
+            if 0 < self.max_seq_length < len(MarkupEncoder(self.word_pieces, words, clusters)):
+                num_examples_filtered += mentions
+            else:
+                for c_i, cluster in enumerate(clusters):
+                    for mention in cluster:
+                        current_cluster_examples.append((f"{idx}_{chunk_id}", paragraph, c_i, mention))
             print(f"clusters: idx = {idx} chunk_id = {chunk_id} mention_examples = {len(current_cluster_examples)} / {mentions}")
-            self.cluster_examples.extend(current_cluster_examples)
-        return num_examples_filtered
+            cluster_examples.extend(current_cluster_examples)
+        return num_examples_filtered, cluster_examples
 
     @staticmethod
     def clean_span(span):
@@ -341,9 +820,71 @@ class CoresDatasetPreProcessor(object):
 
         return examples_with_env
 
+    # mentions_df / clusters_df as Arrow tables (tables_dir/mentions, tables_dir/clusters) and the builder
+    # statistics in tables_dir/builder.json, see BuilderTables
+    def save_tables(self, tables_dir):
+        tmp_dir = f'{tables_dir}.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.mentions_df.save_to_disk(os.path.join(tmp_dir, 'mentions'))
+        self.clusters_df.save_to_disk(os.path.join(tmp_dir, 'clusters'))
+        stats = {name : getattr(self, name) for name in BuilderTables.STATS}
+        with open(os.path.join(tmp_dir, 'builder.json'), 'w') as f:
+            json.dump(stats, f)
+        os.replace(tmp_dir, tables_dir)
+
     def __len__(self):
         return len(self.examples)
 
+# A saved train builder. mentions_df / clusters_df are memory-mapped datasets.Dataset tables, only the rows and
+# columns that are read are loaded, so opening a builder does not depend on its size.
+class BuilderTables(object):
+    STATS = ['max_seq_length', 'max_mention_num', 'max_cluster_size', 'max_num_clusters',
+             'num_mention_examples_filtered', 'num_cluster_examples_filtered']
+
+    def __init__(self, tables_dir):
+        self.tables_dir = tables_dir
+        with open(os.path.join(tables_dir, 'builder.json'), 'r') as f:
+            self.__dict__.update(json.load(f))
+        self.mentions_df = datasets.load_from_disk(os.path.join(tables_dir, 'mentions'))
+        self.clusters_df = datasets.load_from_disk(os.path.join(tables_dir, 'clusters'))
+
+# Tables directory (BuilderTables) or an old pickled builder
+def load_builder(builder_path):
+    if os.path.isdir(builder_path):
+        return BuilderTables(builder_path)
+    with open(builder_path, 'rb') as f:
+        return pickle.load(f)
+
+# mentions_df / clusters_df of either kind of builder as a datasets.Dataset
+def as_dataset(table):
+    if isinstance(table, Dataset):
+        return table
+    return Dataset.from_pandas(table, preserve_index=False)
+
+# input_str / output_str (and input_ids / labels given word_pieces) of a clusters_df row. The row only points at
+# its paragraph, a mentions_df row, whose words are input_str split on spaces (conll words have no spaces).
+# Rows of builders that stored the strings are returned as they are.
+def cluster_example(mentions, example, word_pieces=None):
+    if 'input_str' in example:
+        return example
+    paragraph = mentions[example['paragraph']]
+    words, clusters = paragraph['input_str'].split(' '), paragraph['clusters']
+    cluster_index, mention = example['cluster_index'], example['mention']
+    example = dict(example)
+    layout = MarkupLayout(words, clusters) if word_pieces is None else MarkupEncoder(word_pieces, words, clusters)
+    example['input_str']  = layout.render(cluster_tag=cluster_index, mention_tag=mention)
+    example['output_str'] = layout.render(cluster_tag=cluster_index, mention_tag=None)
+    if word_pieces is not None:
+        example['input_ids'] = layout.encode(cluster_tag=cluster_index, mention_tag=mention)
+        example['labels']    = layout.encode(cluster_tag=cluster_index, mention_tag=None)
+    return example
+
+# clusters table with the input / target columns of every row, see cluster_example
+def cluster_examples_dataset(mentions, clusters, word_pieces=None):
+    if 'input_str' in clusters.column_names:
+        return clusters
+    return clusters.map(lambda example: cluster_example(mentions, example, word_pieces))
+
 WordsExample = ['--', 'basically', ',', 'it', 'was', 'unanimously', 'agreed', 'upon', 'by', 'the', 'various', 'relevant', 'parties', '.', 'To', 'express', 'its', 'determination', ',', 'the', 'Chinese', 'securities', 'regulatory', 'department', 'compares', 'this', 'stock', 'reform', 'to', 'a', 'die', 'that', 'has', 'been', 'cast', '.', 'It', 'takes', 'time', 'to', 'prove', 'whether', 'the', 'stock', 'reform', 'can', 'really', 'meet', 'expectations', ',', 'and', 'whether', 'any', 'deviations', 'that', 'arise', 'during', 'the', 'stock', 'reform', 'can', 'be', 'promptly', 'corrected', '.', 'Dear', 'viewers', ',', 'the', 'China', 'News', 'program', 'will', 'end', 'here', '.', 'This', 'is', 'Xu', 'Li', '.', 'Thank', 'you', 'everyone', 'for', 'watching', '.', 'Coming', 'up', 'is', 'the', 'Focus', 'Today', 'program', 'hosted', 'by', 'Wang', 'Shilin', '.', 'Good-bye', ',', 'dear', 'viewers', '.']
 
 ClusterExample = [[[16, 16], [19, 23]], [[42, 44], [57, 59], [25, 27]], [[83, 83], [82, 82]]]
@@ -393,13 +934,21 @@ def test_encoder_decoder():
     print()
 
 def create_datasets():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('model_type', type=str)
+    parser.add_argument('training_data_path', type=str)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--shard_size', type=int, default=256)
+    parser.add_argument('--no_shards', action='store_true')
+    args = parser.parse_args(sys.argv[1:])
+
     # path
-    model_type = sys.argv[1]
+    model_type = args.model_type
     if model_type not in ('bert', 't5', 'bart'):
         print('Invalid Model Type')
         sys.exit(0)
 
-    training_data_path = sys.argv[2]
+    training_data_path = args.training_data_path
     if not os.path.exists(training_data_path):
         print(f'Path dont exists {training_data_path}')
         sys.exit(0)
@@ -418,17 +967,26 @@ def create_datasets():
     tokenizer.model_max_length = 128
 
     filename = os.path.basename(training_data_path)
-    dataset_builder_path = os.path.join('.', 'builders', f'{filename}.builder.{model_type}.pkl')
+    max_seq_length = 128
+    config = builder_config(CoresDatasetPreProcessor, tokenizer, max_seq_length)
+    cache = BuilderCache(os.path.join('.', 'builders'), f'{filename}.builder.{model_type}', config, training_data_path)
+    dataset_builder_path = cache.path
     print(f'Builder path: {dataset_builder_path}')
 
-    if os.path.exists(dataset_builder_path):
-        with open(dataset_builder_path, 'rb') as f:
-            builder = pickle.load(f)
+    if cache.exists():
+        builder = load_builder(dataset_builder_path)
     else:
-        builder = CoresDatasetPreProcessor(training_data_path, tokenizer, max_seq_length=128)
-        with open(dataset_builder_path, 'wb') as f:
-            pickle.dump(builder, f)
-            print(f"Success: {dataset_builder_path}")
+        shards_dir = None if args.no_shards else f'{dataset_builder_path}.shards'
+        tables_cache_dir = f'{dataset_builder_path}.tables_cache'
+        builder = CoresDatasetPreProcessor(training_data_path, tokenizer, max_seq_length=max_seq_length, workers=args.workers,
+                                           shards_dir=shards_dir, shard_size=args.shard_size, documents_dir=cache.documents_dir,
+                                           tables_cache_dir=tables_cache_dir)
+        builder.save_tables(dataset_builder_path)
+        if shards_dir is not None:
+            shutil.rmtree(shards_dir, ignore_errors=True)
+        shutil.rmtree(tables_cache_dir, ignore_errors=True)
+        print(f"Success: {dataset_builder_path}")
+    cache.link()
 
 if __name__ == '__main__':
     create_datasets()
@@ -1,10 +1,14 @@
 import json
+import bisect
 import hashlib
 import argparse
 import random
 import logging
 import os
 import pickle
+import shutil
+import zlib
+import itertools
 import time, threading, sys
 
 import datasets
@@ -12,7 +16,7 @@ from metrics import CorefEvaluator, MentionEvaluator
 from datasets import Dataset, concatenate_datasets
 from datasets import Dataset, load_metric
 from utils import extract_mentions_to_predicted_clusters_from_clusters
-from cores_tokens import encode
+from cores_tokens import chunk_words, chunk_fits, pick_chunk_end, balanced_chunks, WordPieces, TokenLengthIndex, MarkupLayout, MarkupEncoder, unspaced_words, build_documents, cluster_stats, iter_jsonlines, builder_config, BuilderCache
 from consts import SPEAKER_START, SPEAKER_END, NULL_ID_FOR_COREF
 from conll import evaluate_conll, output_conll, official_conll_eval
 from transformers import BartForConditionalGeneration, BartTokenizer
@@ -41,23 +45,91 @@ def get_cores_tokens():
 
 
 class CoresDatasetPreProcessorTest(object):
-    def __init__(self, test_data_path, tokenizer, max_seq_length=-1, batch_size=1):
+    def __init__(self, test_data_path, tokenizer, max_seq_length=-1, batch_size=1, packing='greedy', workers=1,
+                 shards_dir=None, shard_size=256, documents_dir=None):
         self.batch_size = batch_size
         self.max_seq_length = max_seq_length
+        self.packing = packing
 
         self.tokenizer = tokenizer
+        self.word_pieces = WordPieces(tokenizer)
         print(f"Reading dataset from {test_data_path}")
-        self.document_examples, self.max_mention_num, self.max_cluster_size, self.max_num_clusters = self._parse_jsonlines(test_data_path)
-        self.paragraph_examples, self.mentions_examples = self._split_to_paragraphs(self.document_examples)
+        self.document_examples = {}
+        self.max_mention_num = -1
+        self.max_cluster_size = -1
+        self.max_num_clusters = -1
+        self.paragraph_examples = []
+        self.mentions_examples = []
+        self.tokenized_document_examples = {}
+        self.cluster_examples = []
+        for (doc_key, document), (paragraph_examples, mentions_examples, tokenized_document, cluster_examples) in \
+                build_documents(self, test_data_path, workers, shards_dir, shard_size, documents_dir):
+            self.document_examples[doc_key] = document
+            mention_num, cluster_size, num_clusters = cluster_stats(document[1])
+            self.max_mention_num = max(self.max_mention_num, mention_num)
+            self.max_cluster_size = max(self.max_cluster_size, cluster_size)
+            self.max_num_clusters = max(self.max_num_clusters, num_clusters)
+            self.paragraph_examples.extend(paragraph_examples)
+            self.mentions_examples.extend(mentions_examples)
+            self.tokenized_document_examples[doc_key] = tokenized_document
+            self.cluster_examples.extend(cluster_examples)
+        self.doc_keys = list(self.document_examples)
+        self.paragraph_index, self.document_paragraphs = self._index_paragraphs()
+        self.paragraph_fingerprints = self._paragraph_fingerprints(self.paragraph_examples)
+        self.mention_targets = self._index_mention_targets()
+        self.tokenized_paragraph_examples = TokenizedParagraphs(self)
         self.united_clusters = self.unite_paragraph_clusters()
-        self.tokenized_paragraph_examples = self._paragraphs_tokenize()
         self.coref_examples = self.tokenized_paragraph_examples
-        self.tokenized_document_examples = self._document_tokenize()
-        _, self.cluster_examples = self._binary_clustering_tokenize(self.mentions_examples)
+
+    # a DataFrame copy of every mentions example, only built when it is asked for
+    @property
+    def mentions_df(self):
         striped_mentions_examples =  [(doc_key, paragraph_id, new_words, entity_mentions) \
                                       for (idx, doc_key, paragraph_id, new_words, new_clusters, entity_mentions) \
                                       in self.mentions_examples]
-        self.mentions_df = pd.DataFrame(striped_mentions_examples, columns=['doc_key', 'paragraph_id', 'input_str', 'output_str'])
+        return pd.DataFrame(striped_mentions_examples, columns=['doc_key', 'paragraph_id', 'input_str', 'output_str'])
+
+    # hash indexes over paragraph_examples / mentions_examples, so inference and evaluation look a document or a
+    # paragraph up instead of scanning the lists
+    def _index_paragraphs(self):
+        paragraph_index = {}
+        document_paragraphs = {doc_key : [] for doc_key in self.doc_keys}
+        for example in self.paragraph_examples:
+            _, doc_key, paragraph_id, _, _, _, _, _ = example
+            paragraph_index[(doc_key, paragraph_id)] = example
+            document_paragraphs.setdefault(doc_key, []).append(example)
+        for doc_key in document_paragraphs:
+            document_paragraphs[doc_key].sort(key=lambda example : example[2])
+        return paragraph_index, document_paragraphs
+
+    @staticmethod
+    def _paragraph_fingerprints(paragraph_examples):
+        return {(example[1], example[2]) : paragraph_fingerprint(flatten_list_of_lists(example[3])) for example in paragraph_examples}
+
+    # fingerprint of the paragraph words, inference results of the paragraph are saved with it
+    def paragraph_fingerprint(self, doc_key, paragraph_id):
+        return self.paragraph_fingerprints[(doc_key, paragraph_id)]
+
+    def _index_mention_targets(self):
+        mention_targets = {}
+        for (_, doc_key, paragraph_id, _, _, entity_mentions) in self.mentions_examples:
+            mention_targets.setdefault((doc_key, paragraph_id), entity_mentions)
+        return mention_targets
+
+    # the paragraph examples of doc_key ordered by paragraph_id
+    def paragraphs(self, doc_key):
+        return self.document_paragraphs.get(doc_key, [])
+
+    # (paragraph_id, sentences, gold clusters) of the paragraphs of doc_key, all inference needs
+    def paragraph_words(self, doc_key):
+        return [(paragraph_id, sentences, clusters) for (_, _, paragraph_id, sentences, clusters, _, _, _) in self.paragraphs(doc_key)]
+
+    def paragraph(self, doc_key, paragraph_id):
+        return self.paragraph_index[(doc_key, paragraph_id)]
+
+    # the gold mentions target (output_str of mentions_df) of a paragraph
+    def mention_target(self, doc_key, paragraph_id):
+        return self.mention_targets[(doc_key, paragraph_id)]
 
     def print_paragraph_examples(self):
         for main_doc_key, (words, main_clusters, speakers, conll_lines) in self.document_examples.items():
@@ -95,47 +167,20 @@ class CoresDatasetPreProcessorTest(object):
     def _binary_clustering_tokenize(self, examples):
         cluster_examples = []
         num_examples_filtered = 0
-        #for (idx, paragraph_id, words, clusters) in examples:
-        for (idx, doc_key, paragraph_id, words, clusters, _) in self.mentions_examples:
+        # (doc_key, paragraph_id) is the paragraph of the example in mentions_examples, the input / target are
+        # rendered from the MarkupLayout of that paragraph
+        for (idx, doc_key, paragraph_id, words, clusters, _) in examples:
             words = flatten_list_of_lists(words)
             
             current_cluster_examples = []
             mentions = sum([len(c) for c in clusters])
-            for c_i, cluster in enumerate(clusters):
-                try:
-                    cluster_output_str = encode(words, clusters, cluster_tag=c_i, mention_tag=None)
-                    cluster_output_str = ' '.join(cluster_output_str)
-                    cluster_output   = self.tokenizer(cluster_output_str, padding="max_length")
-                    output_ids       = cluster_output['input_ids']
-                    output_ids       = torch.tensor(output_ids).unsqueeze(0)
-                    output_ids_mask  = cluster_output['attention_mask']
-                    output_ids_mask  = torch.tensor(output_ids_mask).unsqueeze(0)
-                except:
-                    num_examples_filtered += len(cluster)
-                    continue
-                    
-                if 0 < self.max_seq_length < output_ids.shape[1]:
-                    num_examples_filtered += len(cluster)
-                    continue
-
-                for mention in cluster:
-                    try:
-                        mention_input_str   = encode(words, clusters, cluster_tag=c_i, mention_tag=mention)
-                        mention_input_str   = ' '.join(mention_input_str)
-                        mention_input   = self.tokenizer(mention_input_str, padding="max_length")
-                        input_ids       = mention_input['input_ids']
-                        input_ids       = torch.tensor(input_ids).unsqueeze(0)
-                        input_ids_mask  = mention_input['attention_mask']
-                        input_ids_mask  = torch.tensor(input_ids_mask).unsqueeze(0)
-                    except Exception as e:
-                        num_examples_filtered += 1
-                        continue
-
-                    if 0 < self.max_seq_length < input_ids.shape[1]:
-                        num_examples_filtered += 1
-                        continue
-
-                    current_cluster_examples.append((doc_key, idx, paragraph_id, c_i, mention, mention_input_str, cluster_output_str))
+            # every cluster target and mention input of the paragraph has the length of its markup
+            if 0 < self.max_seq_length < len(MarkupEncoder(self.word_pieces, words, clusters)):
+                num_examples_filtered += mentions
+            else:
+                for c_i, cluster in enumerate(clusters):
+                    for mention in cluster:
+                        current_cluster_examples.append((doc_key, idx, paragraph_id, c_i, mention))
             print(f"clusters: idx = {idx} paragraph_id = {paragraph_id} mention_examples = {len(current_cluster_examples)} / {mentions}")
             cluster_examples.extend(current_cluster_examples)
         return num_examples_filtered, cluster_examples
@@ -183,225 +228,169 @@ class CoresDatasetPreProcessorTest(object):
                 
         return united_clusters
 
-    def _document_tokenize(self):
-        tokenized_document_examples = {}
-        lengths = []
-        num_examples_filtered = 0
-        for doc_key, (words, clusters, speakers, _) in self.document_examples.items():
-            words = flatten_list_of_lists(words)
-            speakers = flatten_list_of_lists(speakers)
-
-            word_idx_to_start_token_idx = dict()
-            word_idx_to_end_token_idx = dict()
-            end_token_idx_to_word_idx = [0]  # for <s>
-
-            token_ids = []
-            last_speaker = None
-            for idx, (word, speaker) in enumerate(zip(words, speakers)):
-                if last_speaker != speaker:
-                    speaker_prefix = [SPEAKER_START] + self.tokenizer.encode(" " + speaker,
-                                                                             add_special_tokens=False) + [SPEAKER_END]
-                    last_speaker = speaker
-                else:
-                    speaker_prefix = []
-                for _ in range(len(speaker_prefix)):
-                    end_token_idx_to_word_idx.append(idx)
-                token_ids.extend(speaker_prefix)
-                word_idx_to_start_token_idx[idx] = len(token_ids) + 1  # +1 for <s>
-                tokenized = self.tokenizer.encode(" " + word, add_special_tokens=False)
-                for _ in range(len(tokenized)):
-                    end_token_idx_to_word_idx.append(idx)
-                token_ids.extend(tokenized)
-                word_idx_to_end_token_idx[idx] = len(token_ids)  # old_seq_len + 1 (for <s>) + len(tokenized_word) - 1 (we start counting from zero) = len(token_ids)
-
-            # BIG NO NO!
-            #if 0 < self.max_seq_length < len(token_ids):
-            #    num_examples_filtered += 1
-            #    continue
-
-            new_clusters = [
-                [(word_idx_to_start_token_idx[start], word_idx_to_end_token_idx[end]) for start, end in cluster] for
-                cluster in clusters]
-            lengths.append(len(token_ids))
-            tokenized_document_examples[doc_key] = (end_token_idx_to_word_idx, token_ids, new_clusters, 
-                                                    word_idx_to_start_token_idx, word_idx_to_end_token_idx)
-        return tokenized_document_examples
-
-    def _paragraphs_tokenize(self):
-        tokenized_paragraph_examples = {}
-
-        #for doc_key, words, clusters, speakers in examples:
-        for _, doc_key, paragraph_id, sentences, clusters, sentences_speakers, _, _ in self.paragraph_examples:
-            words = flatten_list_of_lists(sentences)
-            speakers = flatten_list_of_lists(sentences_speakers)
-
-            word_idx_to_start_token_idx = dict()
-            word_idx_to_end_token_idx = dict()
-            end_token_idx_to_word_idx = [0]  # for <s>
-
-            token_ids = []
-            last_speaker = None
-            for idx, (word, speaker) in enumerate(zip(words, speakers)):
-                if last_speaker != speaker:
-                    speaker_prefix = [SPEAKER_START] + self.tokenizer.encode(" " + speaker,
-                                                                             add_special_tokens=False) + [SPEAKER_END]
-                    last_speaker = speaker
-                else:
-                    speaker_prefix = []
-                for _ in range(len(speaker_prefix)):
-                    end_token_idx_to_word_idx.append(idx)
-                token_ids.extend(speaker_prefix)
-                word_idx_to_start_token_idx[idx] = len(token_ids) + 1  # +1 for <s>
-                tokenized = self.tokenizer.encode(" " + word, add_special_tokens=False)
-                for _ in range(len(tokenized)):
-                    end_token_idx_to_word_idx.append(idx)
-                token_ids.extend(tokenized)
-                word_idx_to_end_token_idx[idx] = len(token_ids)  # old_seq_len + 1 (for <s>) + len(tokenized_word) - 1 (we start counting from zero) = len(token_ids)
-            new_clusters = [
-                [(word_idx_to_start_token_idx[start], word_idx_to_end_token_idx[end]) for start, end in cluster] for
-                cluster in clusters]
-
-            tokenized_paragraph_examples[(doc_key, paragraph_id)] = (end_token_idx_to_word_idx, token_ids, new_clusters, 
-                                                       word_idx_to_start_token_idx, word_idx_to_end_token_idx)
-            for idx, word in enumerate(words):
-                x = word_idx_to_start_token_idx[idx]
-                x = word_idx_to_end_token_idx[idx]
-        return tokenized_paragraph_examples
-
-    def _parse_jsonlines(self, test_data_path):
-        examples = {}
-        max_mention_num = -1
-        max_cluster_size = -1
-        max_num_clusters = -1
-        with open(test_data_path, 'r') as f:
-            for line in f:
-                d = json.loads(line.strip())
-                doc_key = d["doc_key"]
-                input_words = d["sentences"]
-                clusters = d["clusters"]
-                speakers = d["speakers"]
-                try:
-                    conll_lines = d["full_sentences"]
-                except:
-                    conll_lines = 'EMPTY!'
-                max_mention_num = max(max_mention_num, len(flatten_list_of_lists(clusters)))
-                max_cluster_size = max(max_cluster_size, max(len(cluster) for cluster in clusters) if clusters else 0)
-                max_num_clusters = max(max_num_clusters, len(clusters) if clusters else 0)
-                examples[doc_key] = (input_words, clusters, speakers, conll_lines)
-
-        return examples, max_mention_num, max_cluster_size, max_num_clusters
-
-    def _trunc_words(self, words, clusters, trunc_sentences_count):
-        if trunc_sentences_count > 0:
-            w = words[:-trunc_sentences_count]
-        else:
-            w = words
-        w_flatten = flatten_list_of_lists(w)
-
-        new_clusters = [ [[start, end] for start, end in cluster if start < len(w_flatten) and end < len(w_flatten)] for cluster in clusters ]
-        new_clusters = [ cluster for cluster in new_clusters if cluster ]
-        mentions_count = sum([len(c) for c in new_clusters])
-        #print(f'len(w) = {len(w)}, len(w_flatten) = {len(w_flatten)}, mentions_count = {mentions_count}')
-        return w, new_clusters
-
-    def _process_example(self, words, clusters, trunc_step=1):
-        w = list(words)
-        trunc_sentences_count = 0
-        total_mention_count = sum([len(c) for c in clusters])
-        while w:
-            w, new_clusters  = self._trunc_words(list(words), clusters, trunc_sentences_count)
-            w_flatten        = flatten_list_of_lists(w)
-            words_str        = ' '.join(w_flatten)
-            tokenized_input  = self.tokenizer(words_str, padding="max_length") # padding
-            input_ids        = tokenized_input['input_ids']
-            input_ids        = torch.tensor(input_ids).unsqueeze(0)
-            input_ids_mask   = tokenized_input['attention_mask']
-            input_ids_mask   = torch.tensor(input_ids_mask).unsqueeze(0)
-
-            entity_mentions = encode(w_flatten, new_clusters, None)
-            entity_mentions = ' '.join(entity_mentions)
-            tokenized_output = self.tokenizer(entity_mentions, padding="max_length")
-            output_ids       = tokenized_output['input_ids']
-            output_ids       = torch.tensor(output_ids).unsqueeze(0)
-            output_ids_mask  = tokenized_output['attention_mask']
-            output_ids_mask  = torch.tensor(output_ids_mask).unsqueeze(0)
-
-            #output_str = self.tokenizer.batch_decode(output_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
-            if 0 < self.max_seq_length < input_ids.shape[1]:
-                trunc_sentences_count += trunc_step
-                continue
-                
-            if 0 < self.max_seq_length < output_ids.shape[1]:
-                trunc_sentences_count += trunc_step
-                continue
-            break
-            print('Done')
-        return w, words_str, new_clusters, trunc_sentences_count, entity_mentions
-
-    def _split_to_paragraphs(self, examples):
+    # Everything the builder keeps for a single document, documents are independent of each other.
+    def _process_document(self, idx, example):
+        doc_key, (words, clusters, speakers, conll_lines) = example
+        # the words (and speakers) of the document are tokenized in two batches before the paragraphs are packed, the
+        # packing and the document map then only read the memo and the paragraph maps are cut out of the document one
+        sentence_starts = list(itertools.accumulate([0] + [len(sentence) for sentence in words[:-1]]))
+        self.word_pieces.update(flatten_list_of_lists(words) + flatten_list_of_lists(speakers))
+        self.word_pieces.update(unspaced_words(flatten_list_of_lists(words), clusters, sentence_starts), leading_space=False)
+        paragraph_examples, mentions_examples = self._split_document(idx, doc_key, words, clusters, speakers, conll_lines)
+        tokenized_document = self._document_tokenize(words, clusters, speakers)
+        _, cluster_examples = self._binary_clustering_tokenize(mentions_examples)
+        return paragraph_examples, mentions_examples, tokenized_document, cluster_examples
+
+    # A cached _process_document result with the idx of the document in the current file.
+    def _reindex(self, result, idx):
+        paragraph_examples, mentions_examples, tokenized_document, cluster_examples = result
+        paragraph_examples = [(idx,) + tuple(example[1:]) for example in paragraph_examples]
+        mentions_examples = [(idx,) + tuple(example[1:]) for example in mentions_examples]
+        cluster_examples = [(doc_key, idx, paragraph_id, c_i, mention) for doc_key, _, paragraph_id, c_i, mention in cluster_examples]
+        return paragraph_examples, mentions_examples, tokenized_document, cluster_examples
+
+    def _document_tokenize(self, words, clusters, speakers):
+        words = flatten_list_of_lists(words)
+        speakers = flatten_list_of_lists(speakers)
+
+        word_idx_to_start_token_idx = dict()
+        word_idx_to_end_token_idx = dict()
+        end_token_idx_to_word_idx = [0]  # for <s>
+
+        token_ids = []
+        last_speaker = None
+        for idx, (word, speaker) in enumerate(zip(words, speakers)):
+            if last_speaker != speaker:
+                speaker_prefix = [SPEAKER_START] + self.word_pieces(speaker) + [SPEAKER_END]
+                last_speaker = speaker
+            else:
+                speaker_prefix = []
+            for _ in range(len(speaker_prefix)):
+                end_token_idx_to_word_idx.append(idx)
+            token_ids.extend(speaker_prefix)
+            word_idx_to_start_token_idx[idx] = len(token_ids) + 1  # +1 for <s>
+            tokenized = self.word_pieces(word)
+            for _ in range(len(tokenized)):
+                end_token_idx_to_word_idx.append(idx)
+            token_ids.extend(tokenized)
+            word_idx_to_end_token_idx[idx] = len(token_ids)  # old_seq_len + 1 (for <s>) + len(tokenized_word) - 1 (we start counting from zero) = len(token_ids)
+
+        # BIG NO NO!
+        #if 0 < self.max_seq_length < len(token_ids):
+        #    continue
+
+        new_clusters = [
+            [(word_idx_to_start_token_idx[start], word_idx_to_end_token_idx[end]) for start, end in cluster] for
+            cluster in clusters]
+        return (end_token_idx_to_word_idx, token_ids, new_clusters, 
+                word_idx_to_start_token_idx, word_idx_to_end_token_idx)
+
+    # _document_tokenize of the paragraph words, re-based from the tokenized document. The paragraph is the document
+    # tokens of its words, only its first word always gets a speaker prefix (the same prefix the document has there
+    # on a speaker change).
+    def _paragraph_tokenize(self, paragraph_example):
+        _, doc_key, _, sentences, clusters, sentences_speakers, _, index_shift = paragraph_example
+        end_token_idx_to_word_idx, token_ids, _, word_idx_to_start_token_idx, word_idx_to_end_token_idx = \
+            self.tokenized_document_examples[doc_key]
+        # a speaker per word, otherwise the document zip does not pair the paragraph words the way its own would
+        document_words, _, document_speakers, _ = self.document_examples[doc_key]
+        num_words = len(flatten_list_of_lists(sentences))
+        if num_words == 0 or [len(s) for s in document_words] != [len(s) for s in document_speakers]:
+            return self._document_tokenize(sentences, clusters, sentences_speakers)
+
+        speaker = sentences_speakers[0][0]
+        speaker_prefix = [SPEAKER_START] + self.word_pieces(speaker) + [SPEAKER_END]
+        begin = word_idx_to_start_token_idx[index_shift] - 1
+        end = word_idx_to_end_token_idx[index_shift + num_words - 1]
+        shift = len(speaker_prefix) - begin
+
+        paragraph_token_ids = speaker_prefix + token_ids[begin:end]
+        paragraph_end_token_idx_to_word_idx = [0] * (len(speaker_prefix) + 1) + \
+                                              [idx - index_shift for idx in end_token_idx_to_word_idx[begin + 1:end + 1]]
+        paragraph_word_idx_to_start_token_idx = {idx : word_idx_to_start_token_idx[idx + index_shift] + shift for idx in range(num_words)}
+        paragraph_word_idx_to_end_token_idx = {idx : word_idx_to_end_token_idx[idx + index_shift] + shift for idx in range(num_words)}
+        new_clusters = [
+            [(paragraph_word_idx_to_start_token_idx[start], paragraph_word_idx_to_end_token_idx[end]) for start, end in cluster] for
+            cluster in clusters]
+        return (paragraph_end_token_idx_to_word_idx, paragraph_token_ids, new_clusters,
+                paragraph_word_idx_to_start_token_idx, paragraph_word_idx_to_end_token_idx)
+
+    def _read_jsonlines(self, test_data_path, skip=0):
+        for d in iter_jsonlines(test_data_path, skip):
+            doc_key = d["doc_key"]
+            input_words = d["sentences"]
+            clusters = d["clusters"]
+            speakers = d["speakers"]
+            try:
+                conll_lines = d["full_sentences"]
+            except:
+                conll_lines = 'EMPTY!'
+            yield (doc_key, (input_words, clusters, speakers, conll_lines))
+
+    # (start, end) word ranges of a document's paragraphs. Paragraphs end on sentence boundaries (sentence_ends)
+    # and each is the largest run of sentences that fits max_seq_length ('greedy'), or the same number of
+    # paragraphs with evened out lengths ('balanced').
+    def _pack_sentences(self, words, clusters, sentence_ends):
+        if self.max_seq_length <= 0:
+            return [(0, len(words))]
+        index  = TokenLengthIndex(words, clusters, self.word_pieces)
+        budget = self.max_seq_length - self.tokenizer.num_special_tokens_to_add()
+        fits   = lambda start, end: chunk_fits(self.word_pieces, words, clusters, start, end, self.max_seq_length)
+
+        chunks = []
+        start = 0
+        while start < len(words):
+            end = pick_chunk_end(index, start, budget, sentence_ends, lambda end: fits(start, end))
+            chunks.append((start, end))
+            start = end
+
+        if self.packing == 'balanced' and len(chunks) > 1:
+            balanced = balanced_chunks(index, sentence_ends, budget, len(chunks))
+            if balanced is not None and all(fits(start, end) for start, end in balanced):
+                chunks = balanced
+        return chunks
+
+    def _split_document(self, idx, doc_key, words, clusters, speakers, conll_lines):
         paragraph_examples = []
         mentions_examples = []
-        idx = 0
-        for doc_key, (words, clusters, speakers, conll_lines) in examples.items():
-            total_mentions = extract_mentions_to_predicted_clusters_from_clusters(clusters)
-            total_mentions = tuple(total_mentions.keys())
-            mentions_left  = len(total_mentions)
-
-            paragraph_id = 0
-            index_shift = 0
-            total_length = len(flatten_list_of_lists(words))
-            new_words, words_str, new_clusters, trunc_sentences_count, entity_mentions = self._process_example(words, clusters)
-            new_speakers = speakers[:len(new_words)]
-            new_conll_lines = conll_lines[:len(new_words)]
+        total_mentions = extract_mentions_to_predicted_clusters_from_clusters(clusters)
+        total_mentions = tuple(total_mentions.keys())
+        mentions_left  = len(total_mentions)
+
+        flat_words = flatten_list_of_lists(words)
+        total_length = len(flat_words)
+        sentence_ends = []
+        for sentence in words:
+            sentence_ends.append((sentence_ends[-1] if sentence_ends else 0) + len(sentence))
+
+        paragraph_id = 0
+        for start, end in self._pack_sentences(flat_words, clusters, sentence_ends):
+            first_sentence = bisect.bisect_right(sentence_ends, start)
+            last_sentence  = bisect.bisect_left(sentence_ends, end) + 1
+            if last_sentence - first_sentence == 1 and 0 < self.max_seq_length and \
+               not chunk_fits(self.word_pieces, flat_words, clusters, start, end, self.max_seq_length):
+                print(f"No New Words!")
+                continue
+
+            new_words        = words[first_sentence:last_sentence]
+            new_speakers     = speakers[first_sentence:last_sentence]
+            new_conll_lines  = conll_lines[first_sentence:last_sentence]
+            _, new_clusters  = chunk_words(flat_words, clusters, start, end)
+            entity_mentions  = MarkupLayout(flat_words[start:end], new_clusters).render()
+            index_shift      = start # the length of the sentence so it will be possible to restore the indexes to original sentence
             new_mentions = extract_mentions_to_predicted_clusters_from_clusters(new_clusters)
             new_mentions = tuple(new_mentions.keys())
             mentions_left -= len(new_mentions)
 
-            paragraph_examples.append((idx, doc_key, paragraph_id, new_words, new_clusters, new_speakers, new_conll_lines, index_shift))
-            mentions_examples.append((idx, doc_key, paragraph_id, new_words, new_clusters, entity_mentions))
-            trunced_length = len(new_words)
-            print(f"idx = {idx} / doc_key = {doc_key} paragraph_id = {paragraph_id} sentences={trunced_length}/{len(words)} shift = {index_shift} / {total_length} mentions = {len(new_mentions)} / {len(total_mentions)}")
-            while trunced_length <  len(words):
-                remain_words       = words[trunced_length:]
-                remain_speakers    = speakers[trunced_length:]
-                remain_conll_lines = conll_lines[trunced_length:]
-
-                full_trunced_length = len(flatten_list_of_lists(new_words))
-                index_shift += full_trunced_length # the length of the sentence so it will be possible to restore the indexes to original sentence
-
-                remain_clusters = [ [[start - index_shift , end - index_shift] for start, end in cluster \
-                                  if start >= index_shift and end >= index_shift] for cluster in clusters ]
-                remain_clusters = [ cluster for cluster in remain_clusters if cluster ]
-
-                new_words, words_str, new_clusters, trunc_sentences_count, entity_mentions = self._process_example(remain_words, remain_clusters)
-                if not new_words:
-                    print(f"No New Words!")
-                    trunced_length += 1
-                    continue
-
-                new_speakers = remain_speakers[:len(new_words)]
-                new_conll_lines = remain_conll_lines[:len(new_words)]
-                new_mentions = extract_mentions_to_predicted_clusters_from_clusters(new_clusters)
-                new_mentions = tuple(new_mentions.keys())
-                mentions_left -= len(new_mentions)
-                
-                paragraph_id += 1
-                trunced_length += len(new_words)
-                if new_clusters:
-                    paragraph_examples.append((idx, doc_key, paragraph_id, new_words, new_clusters, new_speakers, new_conll_lines, index_shift))
-                    mentions_examples.append((idx, doc_key, paragraph_id, new_words, new_clusters, entity_mentions))
-                    print(f"idx = {idx} / doc_key = {doc_key} paragraph_id = {paragraph_id} sentences={trunced_length}/{len(words)} shift = {index_shift} / {total_length} mentions = {len(new_mentions)} / {len(total_mentions)}")
-                else:
-                    print(f"IGNORED! idx = {idx} / doc_key = {doc_key} paragraph_id = {paragraph_id} sentences={trunced_length}/{len(words)} shift = {index_shift} / {total_length} mentions = {len(new_mentions)} / {len(total_mentions)}")
-
-                if new_words == remain_words and new_words:
-                    #print(f"Trunc another sentence")
-                    trunced_length += 1
-                    continue
-            print(f'mentions left = {mentions_left}')
-            print(f'mentions left = {mentions_left}')
-            print()
-            idx += 1
+            if paragraph_id == 0 or new_clusters:
+                paragraph_examples.append((idx, doc_key, paragraph_id, new_words, new_clusters, new_speakers, new_conll_lines, index_shift))
+                mentions_examples.append((idx, doc_key, paragraph_id, new_words, new_clusters, entity_mentions))
+                print(f"idx = {idx} / doc_key = {doc_key} paragraph_id = {paragraph_id} sentences={last_sentence}/{len(words)} shift = {index_shift} / {total_length} mentions = {len(new_mentions)} / {len(total_mentions)}")
+            else:
+                print(f"IGNORED! idx = {idx} / doc_key = {doc_key} paragraph_id = {paragraph_id} sentences={last_sentence}/{len(words)} shift = {index_shift} / {total_length} mentions = {len(new_mentions)} / {len(total_mentions)}")
+            paragraph_id += 1
+        print(f'mentions left = {mentions_left}')
+        print()
 
         return paragraph_examples, mentions_examples
 
@@ -415,18 +404,7 @@ class CoresDatasetPreProcessorTest(object):
         self.to_paragraphs_ontonotes(conll_gold_path)
 
         for idx, doc_key, paragraph_id, sentences, untokenized_gold_clusters, _, _, index_shift in self.paragraph_examples:
-            words = flatten_list_of_lists(sentences)
-            words = [w.lower() for w in words]
-            try:
-                words_str = ' '.join(words)
-            except UnicodeEncodeError:
-                print('Unicode is not supported')
-                continue
-
-            try:
-                input_words_str_md5 = hashlib.md5(words_str.encode('ascii')).hexdigest()
-            except:
-                input_words_str_md5 = hashlib.md5(words_str.encode('utf-8')).hexdigest()
+            fingerprint = self.paragraph_fingerprints[(doc_key, paragraph_id)]
 
             # predict_clusters = load from file by doc_key and paragraph_id
             # inference_dir
@@ -440,13 +418,13 @@ class CoresDatasetPreProcessorTest(object):
             try:
                 with open(inference_results, 'rb') as f:
                     results = pickle.load(f)
-                _, _, untok_predicted_clusters, pickled_input_words_str_md5, _, _, _ = results
+                _, _, untok_predicted_clusters, pickled_fingerprint, _, _, _ = results
             except:
                 print(f'{inference_results} loading problem continue!')
                 continue
 
-            if pickled_input_words_str_md5 != input_words_str_md5:
-                print(f'Invalid MD5 for {inference_results}')
+            if not same_paragraph(fingerprint, pickled_fingerprint, sentences):
+                print(f'Invalid fingerprint for {inference_results}')
                 continue
 
             subtoken_maps, _, gold_clusters, word_idx_to_start_token_idx, word_idx_to_end_token_idx = self.tokenized_paragraph_examples[(doc_key, paragraph_id)]
@@ -501,7 +479,7 @@ class CoresDatasetPreProcessorTest(object):
         united_untok_predicted_clusters = {}
         united_untok_golden_clusters = {}
         # iterate only over the keys from the monitor
-        done_keys, done_keys_ratio = monitor_inference(self.document_examples.keys(), inference_dir)
+        done_keys, done_keys_ratio = monitor_inference(self.doc_keys, inference_dir)
         for idx, doc_key, paragraph_id, sentences, untokenized_gold_clusters, _, _, index_shift in self.paragraph_examples:
             if doc_key not in done_keys:
                 continue
@@ -509,18 +487,7 @@ class CoresDatasetPreProcessorTest(object):
                 print(f'Very strange! {doc_key}')
                 continue
 
-            words = flatten_list_of_lists(sentences)
-            words = [w.lower() for w in words]
-            try:
-                words_str = ' '.join(words)
-            except UnicodeEncodeError:
-                print('Unicode is not supported')
-                continue
-
-            try:
-                input_words_str_md5 = hashlib.md5(words_str.encode('ascii')).hexdigest()
-            except:
-                input_words_str_md5 = hashlib.md5(words_str.encode('utf-8')).hexdigest()
+            fingerprint = self.paragraph_fingerprints[(doc_key, paragraph_id)]
 
             # predict_clusters = load from file by doc_key and paragraph_id
             # inference_dir
@@ -534,13 +501,13 @@ class CoresDatasetPreProcessorTest(object):
             try:
                 with open(inference_results, 'rb') as f:
                     results = pickle.load(f)
-                _, _, untok_predicted_clusters, pickled_input_words_str_md5, _, _, _ = results
+                _, _, untok_predicted_clusters, pickled_fingerprint, _, _, _ = results
             except:
                 print(f'{inference_results} loading problem continue!')
                 continue
 
-            if pickled_input_words_str_md5 != input_words_str_md5:
-                print(f'Invalid MD5 for {inference_results}')
+            if not same_paragraph(fingerprint, pickled_fingerprint, sentences):
+                print(f'Invalid fingerprint for {inference_results}')
                 continue
 
             shift_untok_predicted_clusters = [[[start + index_shift, end + index_shift] for start, end in cluster] for cluster in untok_predicted_clusters]
@@ -661,9 +628,153 @@ class CoresDatasetPreProcessorTest(object):
         official_f1 = sum(results["f"] for results in conll_results.values()) / len(conll_results)
         print('Official avg F1: %.4f' % official_f1)
 
+    # Saves the builder as TestBuilderSections: every section is its own pickle in sections_dir.
+    def save_sections(self, sections_dir):
+        tmp_dir = f'{sections_dir}.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        paragraph_keys = [(doc_key, paragraph_id) for (_, doc_key, paragraph_id, _, _, _, _, _) in self.paragraph_examples]
+        sections = {
+            'text' : {'paragraphs' : [(idx, doc_key, paragraph_id, sentences, speakers, index_shift) for \
+                                      (idx, doc_key, paragraph_id, sentences, _, speakers, _, index_shift) in self.paragraph_examples],
+                      'documents' : {doc_key : (sentences, speakers) for doc_key, (sentences, _, speakers, _) in self.document_examples.items()},
+                      'fingerprints' : self.paragraph_fingerprints},
+            'clusters' : {'paragraphs' : dict(zip(paragraph_keys, [example[4] for example in self.paragraph_examples])),
+                          'documents' : {doc_key : document[1] for doc_key, document in self.document_examples.items()}},
+            'conll' : {'paragraphs' : dict(zip(paragraph_keys, [example[6] for example in self.paragraph_examples])),
+                       'documents' : {doc_key : document[3] for doc_key, document in self.document_examples.items()}},
+            'subtokens' : {'tokenizer' : self.tokenizer, 'tokenized_document_examples' : self.tokenized_document_examples},
+            'examples' : {'mentions_examples' : self.mentions_examples, 'cluster_examples' : self.cluster_examples},
+        }
+        for name, section in sections.items():
+            with open(os.path.join(tmp_dir, f'{name}.pkl'), 'wb') as f:
+                pickle.dump(section, f)
+        meta = {name : getattr(self, name) for name in TestBuilderSections.META}
+        with open(os.path.join(tmp_dir, 'builder.json'), 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_dir, sections_dir)
+
     def __len__(self):
         return len(self.examples)
 
+# A test builder saved by save_sections(). Only builder.json is read when it is opened, every other attribute is
+# loaded (or rebuilt) from its sections the first time it is used: inference reads the paragraph text and gold
+# clusters, monitoring nothing else, evaluation the CoNLL lines and subtoken maps too, and the training-style
+# examples only when they are asked for.
+class TestBuilderSections(CoresDatasetPreProcessorTest):
+    META = ['batch_size', 'max_seq_length', 'packing', 'max_mention_num', 'max_cluster_size', 'max_num_clusters', 'doc_keys']
+    LAZY = {
+        'tokenizer' : lambda self: self._section('subtokens')['tokenizer'],
+        'word_pieces' : lambda self: WordPieces(self.tokenizer),
+        'tokenized_document_examples' : lambda self: self._section('subtokens')['tokenized_document_examples'],
+        'mentions_examples' : lambda self: self._section('examples')['mentions_examples'],
+        'cluster_examples' : lambda self: self._section('examples')['cluster_examples'],
+        'mention_targets' : lambda self: self._index_mention_targets(),
+        'paragraph_examples' : lambda self: self._paragraph_examples(),
+        'document_examples' : lambda self: self._document_examples(),
+        'paragraph_index' : lambda self: self._paragraph_indexes()[0],
+        'document_paragraphs' : lambda self: self._paragraph_indexes()[1],
+        'paragraph_texts' : lambda self: self._paragraph_texts(),
+        'paragraph_fingerprints' : lambda self: self._section('text')['fingerprints'],
+        'tokenized_paragraph_examples' : lambda self: TokenizedParagraphs(self),
+        'coref_examples' : lambda self: self.tokenized_paragraph_examples,
+        'united_clusters' : lambda self: self.unite_paragraph_clusters(),
+    }
+
+    def __init__(self, sections_dir):
+        self.sections_dir = sections_dir
+        self.sections = {}
+        with open(os.path.join(sections_dir, 'builder.json'), 'r') as f:
+            self.__dict__.update(json.load(f))
+
+    def __getattr__(self, name):
+        if name not in TestBuilderSections.LAZY or 'sections_dir' not in self.__dict__:
+            raise AttributeError(name)
+        value = TestBuilderSections.LAZY[name](self)
+        setattr(self, name, value)
+        return value
+
+    def _section(self, name):
+        if name not in self.sections:
+            print(f'Loading builder section {name}')
+            with open(os.path.join(self.sections_dir, f'{name}.pkl'), 'rb') as f:
+                self.sections[name] = pickle.load(f)
+        return self.sections[name]
+
+    def _paragraph_examples(self):
+        clusters, conll_lines = self._section('clusters')['paragraphs'], self._section('conll')['paragraphs']
+        return [(idx, doc_key, paragraph_id, sentences, clusters[(doc_key, paragraph_id)], speakers, conll_lines[(doc_key, paragraph_id)], index_shift) \
+                for (idx, doc_key, paragraph_id, sentences, speakers, index_shift) in self._section('text')['paragraphs']]
+
+    def _document_examples(self):
+        clusters, conll_lines = self._section('clusters')['documents'], self._section('conll')['documents']
+        return {doc_key : (sentences, clusters[doc_key], speakers, conll_lines[doc_key]) \
+                for doc_key, (sentences, speakers) in self._section('text')['documents'].items()}
+
+    def _paragraph_indexes(self):
+        self.paragraph_index, self.document_paragraphs = self._index_paragraphs()
+        return self.paragraph_index, self.document_paragraphs
+
+    # paragraph_words of every document, without the CoNLL lines paragraph_examples would need
+    def _paragraph_texts(self):
+        clusters = self._section('clusters')['paragraphs']
+        paragraph_texts = {doc_key : [] for doc_key in self.doc_keys}
+        for (_, doc_key, paragraph_id, sentences, _, _) in self._section('text')['paragraphs']:
+            paragraph_texts.setdefault(doc_key, []).append((paragraph_id, sentences, clusters[(doc_key, paragraph_id)]))
+        for doc_key in paragraph_texts:
+            paragraph_texts[doc_key].sort(key=lambda paragraph : paragraph[0])
+        return paragraph_texts
+
+    def paragraph_words(self, doc_key):
+        return self.paragraph_texts.get(doc_key, [])
+
+# Fingerprint of the lowercased paragraph words an inference result was made for: crc32 and length of their utf-8 text
+def paragraph_fingerprint(words):
+    words_str = ' '.join(w.lower() for w in words).encode('utf-8')
+    return f'{zlib.crc32(words_str):08x}{len(words_str):x}'
+
+# Whether an inference result saved with pickled_fingerprint belongs to the paragraph. Results saved before the
+# fingerprints hold the md5 of the words instead, it is only computed for them.
+def same_paragraph(fingerprint, pickled_fingerprint, sentences):
+    if pickled_fingerprint == fingerprint:
+        return True
+    if not isinstance(pickled_fingerprint, str) or len(pickled_fingerprint) != 32:
+        return False
+    words_str = ' '.join(w.lower() for w in flatten_list_of_lists(sentences))
+    return pickled_fingerprint == hashlib.md5(words_str.encode('utf-8')).hexdigest()
+
+# Sections directory (TestBuilderSections) or an old pickled builder
+def load_test_builder(builder_path):
+    if os.path.isdir(builder_path):
+        return TestBuilderSections(builder_path)
+    with open(builder_path, 'rb') as f:
+        return pickle.load(f)
+
+
+# (doc_key, paragraph_id) -> the tokenized paragraph (as _document_tokenize returns it), derived from the tokenized
+# document on access so the builder keeps a single tokenization of every word.
+class TokenizedParagraphs(object):
+    def __init__(self, builder):
+        self.builder = builder
+        self.paragraphs = builder.paragraph_index
+
+    def __getitem__(self, key):
+        return self.builder._paragraph_tokenize(self.paragraphs[key])
+
+    def __contains__(self, key):
+        return key in self.paragraphs
+
+    def __len__(self):
+        return len(self.paragraphs)
+
+    def __iter__(self):
+        return iter(self.paragraphs)
+
+    def keys(self):
+        return self.paragraphs.keys()
+
+    def items(self):
+        return ((key, self[key]) for key in self.paragraphs)
 
 def generate_true_cluster_example(true_mention, sentence, model_output_mentions):
     for m in model_output_mentions:
@@ -683,13 +794,22 @@ def generate_true_cluster_example(true_mention, sentence, model_output_mentions)
         return sentence
 
 def create_datasets():
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('model_type', type=str)
+    parser.add_argument('test_data_path', type=str)
+    parser.add_argument('--packing', type=str, default='greedy', choices=('greedy', 'balanced'))
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--shard_size', type=int, default=256)
+    parser.add_argument('--no_shards', action='store_true')
+    args = parser.parse_args(sys.argv[1:])
+
     # path
-    model_type = sys.argv[1]
+    model_type = args.model_type
     if model_type not in ('bert', 't5', 'bart'):
         print('Invalid Model Type')
         sys.exit(0)
 
-    test_data_path = sys.argv[2]
+    test_data_path = args.test_data_path
     if not os.path.exists(test_data_path):
         print(f'Path dont exists {test_data_path}')
         sys.exit(0)
@@ -709,22 +829,25 @@ def create_datasets():
 
     filename = os.path.basename(test_data_path)
     builders_dir = os.path.join(r'.', 'new_builders')
-    try:
-        os.mkdir(builders_dir)
-    except:
-        pass
-    dataset_builder_path = os.path.join(builders_dir, f'{filename}.builder.{model_type}.pkl')
+    packing_suffix = '' if args.packing == 'greedy' else f'.{args.packing}'
+    max_seq_length = 128
+    config = builder_config(CoresDatasetPreProcessorTest, tokenizer, max_seq_length, args.packing)
+    cache = BuilderCache(builders_dir, f'{filename}.builder.{model_type}{packing_suffix}', config, test_data_path)
+    dataset_builder_path = cache.path
     print(f'Builder path: {dataset_builder_path}')
 
-    if os.path.exists(dataset_builder_path):
-        with open(dataset_builder_path, 'rb') as f:
-            builder = pickle.load(f)
+    if cache.exists():
+        builder = load_test_builder(dataset_builder_path)
         print(f"Loaded Builder: {dataset_builder_path}")
     else:
-        builder = CoresDatasetPreProcessorTest(test_data_path, tokenizer, max_seq_length=128)
-        with open(dataset_builder_path, 'wb') as f:
-            pickle.dump(builder, f)
+        shards_dir = None if args.no_shards else f'{dataset_builder_path}.shards'
+        builder = CoresDatasetPreProcessorTest(test_data_path, tokenizer, max_seq_length=max_seq_length, packing=args.packing, workers=args.workers,
+                                               shards_dir=shards_dir, shard_size=args.shard_size, documents_dir=cache.documents_dir)
+        builder.save_sections(dataset_builder_path)
+        if shards_dir is not None:
+            shutil.rmtree(shards_dir, ignore_errors=True)
         print(f"Saved Builder: {dataset_builder_path}")
+    cache.link()
     builder.print_paragraph_examples()
 
 def load_pickles():
@@ -736,8 +859,7 @@ def load_pickles():
         sys.exit(0)
 
     print("Loading Builder")
-    with open(dataset_builder_path, 'rb') as f:
-        builder = pickle.load(f)
+    builder = load_test_builder(dataset_builder_path)
     
     infer_dir = sys.argv[2]
     if not os.path.isdir(infer_dir):
@@ -1,4 +1,4 @@
-from cores_tokens import CoresDatasetPreProcessor
+from cores_tokens import CoresDatasetPreProcessor, WordPieces, load_builder, as_dataset, cluster_examples_dataset
 from transformers import BertTokenizerFast
 from transformers import T5Tokenizer, BartTokenizer
 from datasets import Dataset, concatenate_datasets
@@ -7,6 +7,7 @@ from transformers import BartForConditionalGeneration, BartTokenizer
 
 import datasets
 import pickle
+import torch
 import random
 import os
 import sys
@@ -60,15 +61,13 @@ tokenizer.model_max_length = 128
 
 try:
     print("Loading Training Pre-Processor")
-    with open(training_builder_path, 'rb') as f:
-        train_builder = pickle.load(f)
+    train_builder = load_builder(training_builder_path)
 except:
     print(f"Please building New Pre-Processor: {training_builder_path} cores_tokens.py/cores_tokens_test.py")
 
 try:
     print("Loading Validation Pre-Processor")
-    with open(val_builder_path, 'rb') as f:
-        val_builder = pickle.load(f)
+    val_builder = load_builder(val_builder_path)
 except:
     print(f"Please building New Pre-Processor: {training_builder_path} cores_tokens.py/cores_tokens_test.py")
 
@@ -76,28 +75,44 @@ print(f"Building Training & Validation Datasets for {model_type}")
 print("Split Training & Validation")
 
 # Make sure that same chunks are used in mentions and clusters validation & training.
-mentions_df_train  = Dataset.from_pandas(train_builder.mentions_df)
-clusters_df_train  = Dataset.from_pandas(train_builder.clusters_df)
-mentions_df_val  = Dataset.from_pandas(val_builder.mentions_df)
-clusters_df_val  = Dataset.from_pandas(val_builder.clusters_df)
+mentions_df_train  = as_dataset(train_builder.mentions_df)
+clusters_df_train  = as_dataset(train_builder.clusters_df)
+mentions_df_val  = as_dataset(val_builder.mentions_df)
+clusters_df_val  = as_dataset(val_builder.clusters_df)
+
+# cluster examples only point at their paragraph (mentions row), the inputs / targets are rendered here
+word_pieces = WordPieces(tokenizer)
+clusters_df_train = cluster_examples_dataset(mentions_df_train, clusters_df_train, word_pieces)
+clusters_df_val = cluster_examples_dataset(mentions_df_val, clusters_df_val, word_pieces)
 
 if model_type == 'bart':
     model = BartForConditionalGeneration.from_pretrained('facebook/bart-base', cache_dir='./cache')
 
+def pad_ids(ids_batch, max_length):
+    ids_batch = [list(ids)[:max_length] for ids in ids_batch]
+    return {
+        'input_ids': [ids + [tokenizer.pad_token_id] * (max_length - len(ids)) for ids in ids_batch],
+        'attention_mask': [[1] * len(ids) + [0] * (max_length - len(ids)) for ids in ids_batch],
+    }
+
+# Builders keep the token ids of every example (MarkupEncoder), older builders only have the strings.
+def encode_column(batch, str_column, ids_column, max_length):
+    if ids_column in batch:
+        return pad_ids(batch[ids_column], max_length)
+    return tokenizer(batch[str_column], padding="max_length", truncation=True, max_length=max_length)
+
 def bart_process_data(example_batch):
     global model
-    input_encodings  = tokenizer.batch_encode_plus(example_batch['input_str'],  padding="max_length", truncation=True, 
-                                                   max_length=encoder_max_length, return_tensors="pt")
-    target_encodings = tokenizer.batch_encode_plus(example_batch['output_str'], padding="max_length", truncation=True, 
-                                                   max_length=decoder_max_length, return_tensors="pt")
+    input_encodings  = encode_column(example_batch, 'input_str', 'input_ids', encoder_max_length)
+    target_encodings = encode_column(example_batch, 'output_str', 'labels', decoder_max_length)
                 
-    labels = target_encodings['input_ids']
+    labels = torch.tensor(target_encodings['input_ids'])
     decoder_input_ids = shift_tokens_right(labels, model.config.pad_token_id, model.config.decoder_start_token_id)
     labels[labels[:, :] == model.config.pad_token_id] = -100
                                 
     encodings = {
-        'input_ids': input_encodings['input_ids'].tolist(),
-        'attention_mask': input_encodings['attention_mask'].tolist(),
+        'input_ids': input_encodings['input_ids'],
+        'attention_mask': input_encodings['attention_mask'],
         'decoder_input_ids': decoder_input_ids.tolist(),
         'labels': labels.tolist(),
     }
@@ -105,13 +120,13 @@ def bart_process_data(example_batch):
 
 def bert_process_data(batch):
     # tokenize the inputs and labels
-    inputs  = tokenizer(batch["input_str"],  padding="max_length", truncation=True, max_length=encoder_max_length)
-    outputs = tokenizer(batch["output_str"], padding="max_length", truncation=True, max_length=decoder_max_length)
-    batch["input_ids"] = inputs.input_ids
-    batch["attention_mask"] = inputs.attention_mask
-    batch["decoder_input_ids"] = outputs.input_ids
-    batch["decoder_attention_mask"] = outputs.attention_mask
-    batch["labels"] = outputs.input_ids.copy()
+    inputs  = encode_column(batch, "input_str", "input_ids", encoder_max_length)
+    outputs = encode_column(batch, "output_str", "labels", decoder_max_length)
+    batch["input_ids"] = inputs["input_ids"]
+    batch["attention_mask"] = inputs["attention_mask"]
+    batch["decoder_input_ids"] = outputs["input_ids"]
+    batch["decoder_attention_mask"] = outputs["attention_mask"]
+    batch["labels"] = outputs["input_ids"].copy()
     # because BERT automatically shifts the labels, the labels correspond exactly to `decoder_input_ids`.
     # We have to make sure that the PAD token is ignored
     batch["labels"] = [[-100 if token == tokenizer.pad_token_id else token for token in labels] for labels in batch["labels"]]
@@ -124,16 +139,16 @@ if model_type == 'bart':
     final_columns.remove("decoder_attention_mask")
 
 print("Converting to tensors")
-mentions_df_train = mentions_df_train.map(conver_func, batched=True, remove_columns=['idx', 'input_str', 'output_str'])
+mentions_df_train = mentions_df_train.map(conver_func, batched=True, remove_columns=mentions_df_train.column_names)
 mentions_df_train.set_format(type="torch", columns=final_columns)
 
-mentions_df_val = mentions_df_val.map(conver_func, batched=True, remove_columns=['idx', 'input_str', 'output_str'])
+mentions_df_val = mentions_df_val.map(conver_func, batched=True, remove_columns=mentions_df_val.column_names)
 mentions_df_val.set_format(type="torch", columns=final_columns)
 
-clusters_df_train = clusters_df_train.map(conver_func, batched=True, remove_columns=['idx', 'cluster_index', 'mention', 'input_str', 'output_str'])
+clusters_df_train = clusters_df_train.map(conver_func, batched=True, remove_columns=clusters_df_train.column_names)
 clusters_df_train.set_format(type="torch", columns=final_columns)
 
-clusters_df_val = clusters_df_val.map(conver_func, batched=True, remove_columns=['idx', 'cluster_index', 'mention', 'input_str', 'output_str'])
+clusters_df_val = clusters_df_val.map(conver_func, batched=True, remove_columns=clusters_df_val.column_names)
 clusters_df_val.set_format(type="torch", columns=final_columns)
 
 print(mentions_df_train["input_ids"].shape)
@@ -9,7 +9,7 @@ import collections
 import os
 
 import conll
-from utils import flatten_list_of_lists
+from utils import flatten_list_of_lists, merge_clusters
 
 
 class DocumentState(object):
@@ -60,22 +60,9 @@ class DocumentState(object):
         return [(s, e, l) for (s, e), l in span_dict.items()]
 
     def finalize(self):
-        merged_clusters = []
-        for c1 in self.clusters.values():
-            existing = None
-            for m in c1:
-                for c2 in merged_clusters:
-                    if m in c2:
-                        existing = c2
-                        break
-                if existing is not None:
-                    break
-            if existing is not None:
-                print("Merging clusters (shouldn't happen very often.)")
-                existing.update(c1)
-            else:
-                merged_clusters.append(set(c1))
-        merged_clusters = [list(c) for c in merged_clusters]
+        merged_clusters = merge_clusters(self.clusters.values())
+        if len(merged_clusters) < len(self.clusters):
+            print("Merging clusters (shouldn't happen very often.)")
         all_mentions = flatten_list_of_lists(merged_clusters)
         assert len(all_mentions) == len(set(all_mentions))
 
@@ -23,7 +23,7 @@ import logging
 from transformers import BartForConditionalGeneration, BartTokenizer
 from transformers import (AdamW, T5ForConditionalGeneration, T5Tokenizer, get_linear_schedule_with_warmup)
 from t5_dataset import CoresDataset
-from cores_tokens import CoresDatasetPreProcessor
+from cores_tokens import CoresDatasetPreProcessor, load_builder
 from t5_tuner import T5FineTuner, LoggingCallback, MyPrintCallback
 from pl_bolts.callbacks import PrintTableMetricsCallback
 
@@ -58,12 +58,10 @@ if input_args.dropout and input_args.dropout < 1 and input_args.dropout > 0:
     dropout = input_args.dropout
 
 train_builder_path = input_args.train_builder_path
-with open(train_builder_path, 'rb') as f:
-    train_builder = pickle.load(f)
+train_builder = load_builder(train_builder_path)
 
 val_builder_path = input_args.val_builder_path
-with open(val_builder_path, 'rb') as f:
-    val_builder = pickle.load(f)
+val_builder = load_builder(val_builder_path)
 
 train_epoch=8
 if input_args.epoch:
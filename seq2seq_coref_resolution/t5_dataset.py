@@ -20,51 +20,42 @@ from torch.utils.data import Dataset, DataLoader
 import pytorch_lightning as pl
 
 from transformers import (AdamW, T5ForConditionalGeneration, T5Tokenizer, get_linear_schedule_with_warmup)
-from cores_tokens import CoresDatasetPreProcessor
+from cores_tokens import CoresDatasetPreProcessor, WordPieces, as_dataset, cluster_example
 
 class CoresDataset(Dataset):
     def __init__(self, tokenizer, builder, max_len):
         self.max_len = max_len
         self.tokenizer = tokenizer
         self.builder = builder
-        self.inputs = []
-        self.targets = []
-        self._build()
+        # examples are read from the builder tables and tokenized when they are asked for
+        self.mentions = as_dataset(builder.mentions_df)
+        self.clusters = as_dataset(builder.clusters_df)
+        self.word_pieces = WordPieces(tokenizer)
     
     def __len__(self):
-        return len(self.inputs)
+        return len(self.mentions) + len(self.clusters)
     
     def __getitem__(self, index):
-        source_ids = self.inputs[index]["input_ids"].squeeze()
-        target_ids = self.targets[index]["input_ids"].squeeze()
+        if index < len(self.mentions):
+            example = self.mentions[index]
+        else:
+            example = cluster_example(self.mentions, self.clusters[index - len(self.mentions)], self.word_pieces)
+        inputs  = self._tokenize(example, 'input_str', 'input_ids')
+        targets = self._tokenize(example, 'output_str', 'labels')
 
-        src_mask    = self.inputs[index]["attention_mask"].squeeze()  # might need to squeeze
-        target_mask = self.targets[index]["attention_mask"].squeeze() # might need to squeeze
+        source_ids = inputs["input_ids"].squeeze()
+        target_ids = targets["input_ids"].squeeze()
+
+        src_mask    = inputs["attention_mask"].squeeze()  # might need to squeeze
+        target_mask = targets["attention_mask"].squeeze() # might need to squeeze
 
         return {"source_ids": source_ids, "source_mask": src_mask, "target_ids": target_ids, "target_mask": target_mask}
     
-    def _build(self):
-        for i in range(len(self.builder.mentions_df)):
-            input_str  = self.builder.mentions_df['input_str'][i]
-            output_str = self.builder.mentions_df['output_str'][i]
-            
-             # tokenize inputs
-            tokenized_inputs = self.tokenizer([input_str],  padding="max_length", truncation=True, max_length=self.max_len, return_tensors="pt")
-             # tokenize targets
-            tokenized_targets = self.tokenizer([output_str],  padding="max_length", truncation=True, max_length=self.max_len, return_tensors="pt")
-
-            self.inputs.append(tokenized_inputs)
-            self.targets.append(tokenized_targets)
-
-        for i in range(len(self.builder.clusters_df)):
-            input_str  = self.builder.clusters_df['input_str'][i]
-            output_str = self.builder.clusters_df['output_str'][i]
-            
-             # tokenize inputs
-            tokenized_inputs = self.tokenizer([input_str],  padding="max_length", truncation=True, max_length=self.max_len, return_tensors="pt")
-
-             # tokenize targets
-            tokenized_targets = self.tokenizer([output_str],  padding="max_length", truncation=True, max_length=self.max_len, return_tensors="pt")
-
-            self.inputs.append(tokenized_inputs)
-            self.targets.append(tokenized_targets)
+    # Builders keep the token ids of every example (MarkupEncoder), older builders only have the strings.
+    def _tokenize(self, example, str_column, ids_column):
+        if ids_column in example:
+            ids = list(example[ids_column])[:self.max_len]
+            padding = self.max_len - len(ids)
+            return {"input_ids": torch.tensor([ids + [self.tokenizer.pad_token_id] * padding]),
+                    "attention_mask": torch.tensor([[1] * len(ids) + [0] * padding])}
+        return self.tokenizer([example[str_column]],  padding="max_length", truncation=True, max_length=self.max_len, return_tensors="pt")
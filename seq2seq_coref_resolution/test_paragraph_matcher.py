@@ -0,0 +1,56 @@
+import io
+import random
+import contextlib
+
+from cores_dir_inference import ParagraphMatcher, clean_text, match_similar_span
+
+def lcs_table(a, b):
+    row = [0] * (len(b) + 1)
+    for c in a:
+        previous, row = row, [0]
+        for j, d in enumerate(b):
+            row.append(previous[j] + 1 if c == d else max(previous[j + 1], row[j]))
+    return row[-1]
+
+# match_similar without the filters: every window scored, the first of the best (inclusive end)
+def brute_force(span_str, words):
+    span_to_find_length = len(span_str.split(' '))
+    if span_to_find_length == 1:
+        return None
+    m = len(span_str)
+    best, best_window = -1, None
+    for w in range(max(1, span_to_find_length - 2), min(len(words), span_to_find_length + 10)):
+        for i in range(len(words) - w + 1):
+            window = ' '.join(words[i : i + w])
+            score = 2 * lcs_table(span_str, window) / (m + len(window))
+            if score > best:
+                best, best_window = score, (i, i + w - 1)
+    return best_window if best > ParagraphMatcher.SIMILAR_RATIO else None
+
+def match_similar(span_str, words):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return ParagraphMatcher(words).match_similar(('', '', span_str, None, 'u'))
+
+def test_punctuation_words():
+    # "on , a" cleans to 'on  a', the '' word joins to a double space
+    assert brute_force('on  a', ['on', 'on', '', 'a']) == (1, 3)
+    assert match_similar('on  a', ['on', 'on', '', 'a']) == (1, 3)
+
+def test_same_as_brute_force():
+    rng = random.Random(0)
+    vocab = ['on', 'a', 'the', 'stock', 'reform', 'he', 'said', 'china', ',', '.', "'s", '--']
+    for _ in range(1500):
+        words = [clean_text(rng.choice(vocab)) for _ in range(rng.randint(2, 30))]
+        start = rng.randrange(len(words) - 1)
+        span_words = list(words[start : start + rng.randint(2, 6)])
+        for _ in range(rng.randint(0, 2)):
+            k = rng.randrange(len(span_words))
+            span_words[k] = span_words[k][:-1] if span_words[k] and rng.random() < 0.5 else span_words[k] + 's'
+        span_str = ' '.join(span_words)
+        assert match_similar(span_str, words) == brute_force(span_str, words), (span_str, words)
+
+def test_match_similar_span_end_is_exclusive():
+    words = ['the', 'stock', 'reform', 'was', 'cast']
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert match_similar_span(('', '', 'stock reforms', None, 'u'), words) == (1, 3)
+        assert match_similar_span(('', '', 'xylophone player', None, 'u'), words) == (-1, -1)
@@ -45,6 +45,55 @@ def extract_clusters_for_decode(mention_to_antecedent):
     return clusters, mention_to_cluster
 
 
+class DisjointSets(object):
+    # union by size with path compression, items keep the order they were added in
+    def __init__(self):
+        self.parents = {}
+        self.sizes = {}
+
+    def add(self, item):
+        if item not in self.parents:
+            self.parents[item] = item
+            self.sizes[item] = 1
+
+    def find(self, item):
+        root = item
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while self.parents[item] != root:
+            self.parents[item], item = root, self.parents[item]
+        return root
+
+    def union(self, a, b):
+        self.add(a)
+        self.add(b)
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return False
+        if self.sizes[a] < self.sizes[b]:
+            a, b = b, a
+        self.parents[b] = a
+        self.sizes[a] += self.sizes[b]
+        return True
+
+    def groups(self):
+        groups = {}
+        for item in self.parents:
+            groups.setdefault(self.find(item), []).append(item)
+        return list(groups.values())
+
+
+def merge_clusters(clusters):
+    sets = DisjointSets()
+    for cluster in clusters:
+        cluster = list(cluster)
+        for item in cluster:
+            sets.add(item)
+        for item in cluster[1:]:
+            sets.union(cluster[0], item)
+    return sets.groups()
+
+
 def mask_tensor(t, mask):
     t = t + ((1.0 - mask.float()) * -10000.0)
     t = torch.clamp(t, min=-10000.0, max=10000.0)